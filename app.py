@@ -1,60 +1,241 @@
 # -------- IMPORTS --------
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
-import os
+from werkzeug.middleware.proxy_fix import ProxyFix
 import json
 
 # -------- UTILS --------
-from utils.model_utils import answer_with_subqueries, fetch_cards_info
-from utils.config_utils import CARDS_FILE
+from utils.model_utils import answer_with_subqueries, iter_answer_stages, fetch_cards_info
+from utils.async_utils import answer_with_subqueries_concurrent
+from utils.card_utils import get_card_store
+from utils.cache_utils import answer_cache, answer_cache_key
+from utils.embedding_utils import embedding_cache
+from utils.metrics_utils import metrics, span, request_timings
+from utils.job_utils import job_queue, QueueFullError
+from utils.mode_utils import resolve_mode, is_valid_mode
+from utils.state_utils import readiness, process_status, memory_usage, startup
+from utils.config_utils import CARDS_SEARCH_LIMIT, CARDS_SEARCH_MAX_LIMIT, ASK_ASYNC_JOBS, JOB_MAX_WAIT_SECONDS, CONCURRENT_PIPELINE, TRUSTED_PROXY_HOPS
 
 import time # just for simulating sending a response in 18 seconds
 
 # -------- INITIALIZATION --------
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
+if TRUSTED_PROXY_HOPS:
+  # behind a reverse proxy remote_addr is the proxy's: take the client address from X-Forwarded-For
+  app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
 # build_index() #todo commented out so it doesn't run every time the server runs
 
 @app.get('/cards')
 def cards():
-  if not os.path.exists(CARDS_FILE):
-    print(f"Card file not found at {CARDS_FILE}")
-    return []
+  card_store = get_card_store()
+  card_store.reload_if_changed()
 
-  with open(CARDS_FILE, "r", encoding="utf-8") as f:
-    cards = json.load(f)
+  # autocomplete mode: ?prefix= matches the start of the name, ?q= the start of any word in the name
+  prefix = request.args.get("prefix")
+  q = request.args.get("q")
+  if prefix is not None or q is not None:
+    try:
+      limit = min(int(request.args.get("limit", CARDS_SEARCH_LIMIT)), CARDS_SEARCH_MAX_LIMIT)
+      cursor = int(request.args.get("cursor", 0))
+    except ValueError:
+      return {"error": "'limit' and 'cursor' must be integers."}, 400
 
-    # extract only names and ids
-    print(f"Loaded {len(cards)} cards")
-    card_list = [{"uuid": c.get("uuid", ""), "name": c.get("name", ""), "multiverseId": c.get("multiverseId", "")} for c in cards if "name" in c]
-  
-    return {"cards": card_list}
+    if limit < 1 or cursor < 0:
+      return {"error": "'limit' must be positive and 'cursor' can't be negative."}, 400
 
-@app.post('/ask')
-def ask():
+    card_list, next_cursor = card_store.search(prefix if prefix is not None else q, words=prefix is None, limit=limit, cursor=cursor)
+    return {"cards": card_list, "next_cursor": next_cursor}
+
+  # full catalog mode: serialized once in the card store, revalidated with ETag
+  catalog = card_store.catalog()
+  if request.if_none_match.contains_weak(catalog.etag):
+    response = Response(status=304)
+  else:
+    body, encoding = catalog.body, None
+    for name in ("br", "gzip"):
+      if name in catalog.encoded and request.accept_encodings.quality(name) > 0:
+        body, encoding = catalog.encoded[name], name
+        break
+
+    response = Response(body, mimetype="application/json")
+    if encoding:
+      response.headers["Content-Encoding"] = encoding
+
+  response.set_etag(catalog.etag, weak=True) # weak: the same catalog is served with several encodings
+  response.headers["Vary"] = "Accept-Encoding"
+  response.headers["Cache-Control"] = "no-cache" # clients may cache but must revalidate with the ETag
+  return response
+
+# -------- HELPER PARSE ASK REQUEST --------
+def parse_ask_request():
+  """
+  Validate an /ask request body. Returns (user_prompt, cards_info, mode_info, None) or (None, None, None, error_response).
+  mode_info is {"mode", "mode_source"}: the optional "mode" (fast, balanced, thorough or auto) or "latency_budget_ms" of the body pick it.
+  """
 
   # if the request is not JSON, return an error
   if not request.is_json:
-    return {"error": "Request must include a JSON in the body with the question parameter"}, 400
+    return None, None, None, ({"error": "Request must include a JSON in the body with the question parameter"}, 400)
   
   # if the request does not contain the required parameters, return an error
   data = request.get_json()
 
   if 'question' not in data:
-    return {"error": "Missing input data: 'question' is required."}, 400
+    return None, None, None, ({"error": "Missing input data: 'question' is required."}, 400)
+
+  mode = data.get("mode")
+  if mode is not None and not is_valid_mode(mode):
+    return None, None, None, ({"error": "'mode' must be one of fast, balanced, thorough or auto."}, 400)
+
+  latency_budget_ms = data.get("latency_budget_ms")
+  if latency_budget_ms is not None and (isinstance(latency_budget_ms, bool) or not isinstance(latency_budget_ms, (int, float)) or latency_budget_ms <= 0):
+    return None, None, None, ({"error": "'latency_budget_ms' must be a positive number."}, 400)
   
   user_prompt = data.get("question", "").strip()
   selected_cards = data.get("cards", [])  # list of card names or ids
 
-  cards_info = []
-  if len(selected_cards) != 0:
-    cards_info = fetch_cards_info(selected_cards)
+  # selected cards plus the ones named in the question
+  cards_info = fetch_cards_info(selected_cards, user_prompt)
+
+  mode, mode_source = resolve_mode(user_prompt, cards_info, mode, latency_budget_ms)
+  metrics.inc("mtg_ask_mode_total", mode=mode, source=mode_source)
+
+  return user_prompt, cards_info, {"mode": mode, "mode_source": mode_source}, None
+
+@app.post('/ask')
+def ask():
+  """
+  Answer a question. With ?timings=1 the response also has a "timings" list with the duration of every stage and call.
+  In async job mode (ASK_ASYNC_JOBS or ?async=1) it answers right away with 202 and a job id to poll at GET /ask/<id>.
+  The answer reports the "mode" it ran in and why ("mode_source").
+  With CONCURRENT_PIPELINE or ?concurrent=1 it is answered by the asyncio pipeline (utils/async_utils.py).
+  """
+  user_prompt, cards_info, mode_info, error = parse_ask_request()
+  if error:
+    return error
+
+  key = answer_cache_key(user_prompt, cards_info, mode_info["mode"])
+  answer_fn = answer_with_subqueries_concurrent if CONCURRENT_PIPELINE or request.args.get("concurrent") in ("1", "true") else answer_with_subqueries
+
+  def compute():
+    # identical questions (same cards, mode and settings) are answered once and shared, even while still running
+    answer = answer_cache.get_or_compute(key, lambda: answer_fn(user_prompt, cards_info, mode_info["mode"]), should_cache=lambda r: "error" not in r)
+    return {**answer, **mode_info} # copy, the cached answer is shared between requests
 
-  response = answer_with_subqueries(user_prompt, cards_info)
-        
+  def compute_job():
+    # the job runs after this request ended: time and count it like a synchronous /ask
+    try:
+      with span("mtg_request_seconds", endpoint="/ask/async"):
+        return compute()
+    except Exception:
+      metrics.inc("mtg_errors_total", endpoint="/ask/async")
+      raise
+
+  if ASK_ASYNC_JOBS or request.args.get("async") in ("1", "true"):
+    cached = answer_cache.get(key)
+    try:
+      job = job_queue.submit(request.remote_addr, compute_job, cached={**cached, **mode_info} if cached is not None else None)
+    except QueueFullError as e:
+      return {"error": str(e)}, 429, {"Retry-After": "10"}
+    status = 200 if job.status == "done" else 202 # cached answers come back finished
+    return job.to_dict(job_queue.position(job)), status, {"Location": f"/ask/{job.id}"}
+
+  with request_timings() as timings:
+    try:
+      with span("mtg_request_seconds", endpoint="/ask"):
+        response = compute()
+    except Exception:
+      metrics.inc("mtg_errors_total", endpoint="/ask")
+      raise
+
+  if request.args.get("timings") in ("1", "true"):
+    response["timings"] = timings # only the request span when the answer came from the cache
   return response
 
+@app.get('/ask/<job_id>')
+def ask_job(job_id):
+  """Status of an async /ask job, with its "result" once done. ?wait=<seconds> long-polls until it finishes."""
+  try:
+    wait = min(float(request.args.get("wait", 0)), JOB_MAX_WAIT_SECONDS)
+  except ValueError:
+    return {"error": "'wait' must be a number of seconds."}, 400
+
+  job = job_queue.wait(job_id, wait)
+  if job is None:
+    return {"error": "Job not found or expired."}, 404
+
+  return job.to_dict(job_queue.position(job))
+
+@app.post('/ask/stream')
+def ask_stream():
+  """Same as /ask, but as Server-Sent Events: one event per finished stage, ruling tokens as they arrive, then "result"."""
+  user_prompt, cards_info, mode_info, error = parse_ask_request()
+  if error:
+    return error
+
+  key = answer_cache_key(user_prompt, cards_info, mode_info["mode"])
+
+  def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+  def generate():
+    yield sse("start", {"question": user_prompt, **mode_info}) # first byte right away, the pipeline takes a while
+
+    cached = answer_cache.get(key)
+    if cached is not None:
+      yield sse("result", cached)
+      return
+
+    try:
+      with span("mtg_request_seconds", endpoint="/ask/stream"):
+        for event, data in iter_answer_stages(user_prompt, cards_info, stream_tokens=True, mode=mode_info["mode"]):
+          if event == "result" and "error" not in data:
+            answer_cache.put(key, data)
+          yield sse(event, data)
+    except Exception as e:
+      print(f"Streaming /ask failed: {e}")
+      metrics.inc("mtg_errors_total", endpoint="/ask/stream")
+      yield sse("error", {"error": "Failed to answer the question."})
+
+  return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get('/metrics')
+def metrics_endpoint():
+  """
+  Latency histograms, token and verdict counters and cache stats of this process, in the Prometheus text format.
+  Under gunicorn every worker keeps its own values and a scrape reaches one of them: run a single worker, or read
+  /metrics per worker, to get totals that don't jump between scrapes.
+  """
+  for name, value in answer_cache.stats().items():
+    metrics.set("mtg_answer_cache", value, stat=name)
+  for name, value in embedding_cache.stats().items():
+    if name != "hit_rate": # derived, Prometheus computes it from the counters
+      metrics.set("mtg_embedding_cache", value, stat=name)
+  for name, value in job_queue.stats().items():
+    metrics.set("mtg_job_queue", value, stat=name)
+  for name, value in memory_usage().items():
+    if value is not None:
+      metrics.set("mtg_process_memory_bytes", value, kind=name)
+  for name, value in startup["components"].items():
+    metrics.set("mtg_startup_seconds", value, component=name)
+  if startup["ready_seconds"] is not None:
+    metrics.set("mtg_startup_seconds", startup["ready_seconds"], component="ready")
+
+  return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get('/healthz')
+def healthz():
+  """Liveness: the process answers requests. Loads nothing, so it stays fast while the worker warms up."""
+  return {"status": "ok", **process_status()}
+
+@app.get('/readyz')
+def readyz():
+  """Readiness: loads what is still missing and answers 200 once the rules, cards and indexes are usable, 503 before."""
+  ready, checks = readiness()
+  return {"ready": ready, "checks": checks, **process_status()}, 200 if ready else 503
+
 #!TEST ROUTE without using the OPEN AI API
 @app.post('/test')
 def test():
@@ -0,0 +1,21 @@
+# gunicorn settings for serving the API with several worker processes: gunicorn -c gunicorn.conf.py app:app
+# the app and its read-only data are loaded once in the master and shared by the forked workers (see utils/state_utils.py)
+# async /ask jobs are shared through job_store/jobs.sqlite3; the answer cache and /metrics are per worker
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5005")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = "gthread" # threads, /ask waits on the OpenAI API and /ask/stream keeps its connection open
+threads = int(os.getenv("THREADS", 8))
+timeout = 180 # seconds, a denied /ask makes several sequential OpenAI calls
+preload_app = True # import app.py in the master, before forking
+
+def when_ready(server):
+    """Master, after importing the app and before forking: load the shared read-only data."""
+    from utils.state_utils import preload
+    preload()
+
+def post_fork(server, worker):
+    """Each worker, right after the fork: Chroma, SQLite and OpenAI connections are opened lazily from here on."""
+    from utils.state_utils import after_fork
+    after_fork()
@@ -0,0 +1,56 @@
+# measure card name detection in questions over the full card pool: trie build time, questions/sec and recall,
+# against the naive approach of checking every card name in every question
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.card_utils import get_card_store, CardNameMatcher
+
+parser = argparse.ArgumentParser(description="Benchmark card name detection in free-text questions.")
+parser.add_argument("--questions", type=int, default=2000, help="number of generated questions")
+parser.add_argument("--naive", type=int, default=50, help="questions also run through the naive scan (it is slow)")
+args = parser.parse_args()
+
+TEMPLATES = [
+    "If I cast {0} while my opponent controls {1}, what happens to the stack?",
+    "Can {0} block a creature equipped by {1} during combat?",
+    "my friend played {0} in response, does it counter it?",
+    "Does {0} trigger when {1} enters the battlefield under my control and I have priority?",
+    "When [{0}] deals damage, is it considered combat damage if {1} is on the battlefield?",
+]
+
+cards = [(c["name"], c.get("uuid", "")) for c in get_card_store().all_cards()]
+print(f"{len(cards)} card names")
+
+start = time.perf_counter()
+matcher = CardNameMatcher(cards)
+print(f"trie built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+# questions with one or two random card names; single word names keep their capital letter like in a real question
+rng = random.Random(0)
+questions = []
+for _ in range(args.questions):
+    picked = rng.sample(cards, 2)
+    template = rng.choice(TEMPLATES)
+    questions.append((template.format(picked[0][0], picked[1][0]), {uuid for _, uuid in picked[:template.count("{")]}))
+
+start = time.perf_counter()
+found = [{uuid for _, uuid in matcher.find(text)} for text, _ in questions]
+elapsed = time.perf_counter() - start
+
+recall = sum(len(f & expected) for f, (_, expected) in zip(found, questions)) / sum(len(expected) for _, expected in questions)
+extra = sum(len(f - expected) for f, (_, expected) in zip(found, questions)) / len(questions)
+print(f"trie:  {len(questions) / elapsed:10.0f} questions/sec ({elapsed / len(questions) * 1e6:.0f} µs each), recall {recall:.3f}, {extra:.2f} extra cards per question (names inside longer names or common words)")
+
+# naive: lowercase substring search of every card name
+subset = questions[:args.naive]
+lowered = [(name.lower(), uuid) for name, uuid in cards]
+start = time.perf_counter()
+for text, _ in subset:
+    text = text.lower()
+    [uuid for name, uuid in lowered if name in text]
+elapsed = time.perf_counter() - start
+print(f"naive: {len(subset) / elapsed:10.0f} questions/sec ({elapsed / len(subset) * 1e6:.0f} µs each)")
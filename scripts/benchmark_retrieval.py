@@ -0,0 +1,53 @@
+# compare recall and latency of the numpy retrieval backend (float32, float16, int8) against Chroma at TOP_K
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import chromadb
+from utils.config_utils import CHROMA_DB_DIR, TOP_K
+from utils.index_utils import get_active_collection_name
+from utils.vector_utils import export_vectors, NumpyVectorStore, EXPORT_DTYPES
+
+parser = argparse.ArgumentParser(description="Benchmark the numpy retrieval backend against Chroma.")
+parser.add_argument("--queries", type=int, default=200, help="number of benchmark queries")
+parser.add_argument("--batch", type=int, default=10, help="queries per search call (like MAX_SUBQUERIES)")
+parser.add_argument("--noise", type=float, default=0.5, help="noise added to stored vectors to make the queries")
+args = parser.parse_args()
+
+chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+collection = chroma_client.get_collection(get_active_collection_name())
+
+# Queries: stored chunk vectors plus gaussian noise, so no embedding API calls are needed
+exports = {dtype: NumpyVectorStore(export_vectors(collection, dtype, publish=False)) for dtype in EXPORT_DTYPES}
+exact = exports["float32"]
+rng = np.random.default_rng(0)
+picked = rng.choice(len(exact), size=min(args.queries, len(exact)), replace=False)
+queries = np.asarray(exact.vectors[picked], dtype=np.float32)
+queries += rng.normal(0, args.noise / np.sqrt(queries.shape[1]), queries.shape).astype(np.float32)
+batches = [queries[i:i + args.batch].tolist() for i in range(0, len(queries), args.batch)]
+
+def run(search):
+    """Run every batch through search. Returns (ids per query, latency per batch in ms)."""
+    ids, latencies = [], []
+    for batch in batches:
+        start = time.perf_counter()
+        result = search(batch)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.extend(result["ids"])
+    return ids, latencies
+
+# Ground truth: exact float32 brute force search
+truth, _ = run(lambda b: exact.query(b, TOP_K))
+
+def report(name, search):
+    ids, latencies = run(search)
+    recall = np.mean([len(set(found) & set(expected)) / len(expected) for found, expected in zip(ids, truth)])
+    print(f"{name:<14} recall@{TOP_K}: {recall:.3f}  p50: {np.percentile(latencies, 50):7.2f} ms  p95: {np.percentile(latencies, 95):7.2f} ms  (per batch of {args.batch})")
+
+print(f"{len(exact)} vectors of {exact.vectors.shape[1]} dims, {len(queries)} queries")
+report("chroma", lambda b: collection.query(query_embeddings=b, n_results=TOP_K))
+for dtype, store in exports.items():
+    report(f"numpy-{dtype}", lambda b, store=store: store.query(b, TOP_K))
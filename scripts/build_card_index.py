@@ -0,0 +1,9 @@
+# index card oracle texts and rulings (run after convert-cards-data.py) so only relevant rulings are sent to the judges
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.card_utils import get_card_store
+from utils.index_utils import build_card_index
+
+build_card_index(get_card_store().all_cards())
@@ -1,29 +1,44 @@
+# Convert the MTGJSON AllPrintings file into the cards database the server reads (one row per card name).
+# The source is streamed card by card with ijson, so memory stays flat however big the file is.
+import os
+import sys
 import json
+import sqlite3
+import argparse
+import ijson
 
-# Load card data
-with open("../data/AllPrintings.json", "r", encoding="utf-8") as f:
-    cardData = json.load(f)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.config_utils import CARDS_DB_FILE
+from utils.card_utils import normalize_name, create_card_tables
 
-allCards = []
+parser = argparse.ArgumentParser(description="Convert MTGJSON AllPrintings.json into the cards database.")
+parser.add_argument("--input", default="./data/AllPrintings.json", help="MTGJSON AllPrintings file")
+parser.add_argument("--output", default=CARDS_DB_FILE, help="SQLite cards database to write")
+parser.add_argument("--json", metavar="PATH", help="also write the cards as a JSON list (the old clean-all-printings.json format)")
+args = parser.parse_args()
 
-# collect all cards from the sections
-for cardSection in cardData["data"]:
-    allCards.extend(cardData["data"][cardSection]["cards"])
+BATCH_SIZE = 1000 # rows inserted per executemany
 
-print(f"Total cards in original data: {len(allCards)}")
+# -------- HELPER ITER CARDS --------
+def iter_cards(f):
+    """Yield every card of every set ("data.<set code>.cards.item"), building only one card object at a time."""
+    builder, card_prefix = None, None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if builder is None:
+            if event == "start_map" and prefix.startswith("data.") and prefix.endswith(".cards.item") and prefix.count(".") == 3:
+                builder, card_prefix = ijson.ObjectBuilder(), prefix
+                builder.event(event, value)
+            continue
 
-seenNames = set()
-output = []
+        builder.event(event, value)
+        if event == "end_map" and prefix == card_prefix:
+            yield builder.value
+            builder = None
 
-for card in allCards:
-    # filter out duplicates by name
-    if card["name"] in seenNames:
-        continue
-    else:
-        seenNames.add(card["name"])
-    
-    # map the card data to the desired output format
-    output.append({
+# -------- HELPER MAP CARD --------
+def map_card(card):
+    """Map the card data to the desired output format, without empty fields."""
+    output = {
         "uuid": card.get("uuid"),                                  # unique id
         "borderColor": card.get("borderColor"),                    # string like black, white, red
         "colors": card.get("colors"),                              # array with ["W", "R"] etc
@@ -41,10 +56,68 @@ for card in allCards:
         "toughness": card.get("toughness"),                        # string for toughness
         "power": card.get("power"),                                # string for power
         "multiverseId": card.get("identifiers", {}).get("multiverseId", "")  # special id used for image fetching from gatherer
-    })
+    }
+    return {k: v for k, v in output.items() if v is not None}
 
-print(f"Total cards in cleaned data: {len(output)}")
+# -------- CONVERT --------
+# write next to the output and swap it in at the end, a running server keeps reading the old database meanwhile
+tmp_path = f"{args.output}.tmp"
+if os.path.exists(tmp_path):
+    os.remove(tmp_path)
 
-# write to JSON
-with open("./clean-all-printings.json", "w", encoding="utf-8") as f:
-    json.dump(output, f, indent=2, ensure_ascii=False)
+db = sqlite3.connect(tmp_path)
+db.execute("PRAGMA journal_mode=OFF")
+db.execute("PRAGMA synchronous=OFF")
+create_card_tables(db)
+
+# same for the JSON cards file: the JSON card store reloads it as soon as its mtime changes
+json_tmp_path = f"{args.json}.tmp" if args.json else None
+json_file = open(json_tmp_path, "w", encoding="utf-8") if args.json else None
+if json_file:
+    json_file.write("[")
+
+seen_names = set()
+total, rows, word_rows = 0, [], []
+
+def flush():
+    db.executemany("INSERT INTO cards (idx, uuid, name, name_key, multiverse_id, data) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    db.executemany("INSERT INTO card_words (word, idx) VALUES (?, ?)", word_rows)
+    rows.clear()
+    word_rows.clear()
+
+with open(args.input, "rb") as f:
+    for card in iter_cards(f):
+        total += 1
+
+        # filter out duplicates by name (first printing wins)
+        if "name" not in card or card["name"] in seen_names:
+            continue
+        seen_names.add(card["name"])
+
+        output = map_card(card)
+        idx = len(seen_names) - 1
+        name_key = normalize_name(output["name"])
+        rows.append((idx, output.get("uuid"), output["name"], name_key, str(output.get("multiverseId", "")), json.dumps(output, ensure_ascii=False, separators=(",", ":"))))
+        for word in set(name_key.split(" ")[1:]): # first word is already covered by the name prefix
+            word_rows.append((word, idx))
+
+        if json_file:
+            json_file.write(("," if idx else "") + json.dumps(output, ensure_ascii=False))
+
+        if len(rows) >= BATCH_SIZE:
+            flush()
+
+flush()
+db.commit()
+db.execute("PRAGMA journal_mode=DELETE")
+db.close()
+os.replace(tmp_path, args.output)
+
+if json_file:
+    json_file.write("]")
+    json_file.close()
+    os.replace(json_tmp_path, args.json)
+
+print(f"Total cards in original data: {total}")
+print(f"Total cards in cleaned data: {len(seen_names)}")
+print(f"Cards database written to {args.output}")
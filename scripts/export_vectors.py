@@ -0,0 +1,17 @@
+# export the active Chroma collection to a memory-mapped matrix for RETRIEVAL_BACKEND = "numpy"
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import chromadb
+from utils.config_utils import CHROMA_DB_DIR, VECTOR_EXPORT_DTYPE
+from utils.index_utils import get_active_collection_name
+from utils.vector_utils import export_vectors, EXPORT_DTYPES
+
+parser = argparse.ArgumentParser(description="Export the rules collection for the numpy retrieval backend.")
+parser.add_argument("--dtype", choices=EXPORT_DTYPES, default=VECTOR_EXPORT_DTYPE, help="storage type of the exported vectors")
+args = parser.parse_args()
+
+chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+export_vectors(chroma_client.get_collection(get_active_collection_name()), args.dtype)
@@ -0,0 +1,141 @@
+# local OpenAI-compatible stand-in for load tests: canned chat completions (plain and streamed) and deterministic embeddings
+# point the app at it with OPENAI_BASE_URL=http://localhost:8100/v1 (any OPENAI_API_KEY works)
+import re
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import argparse
+import numpy as np
+from flask import Flask, Response, request
+
+parser = argparse.ArgumentParser(description="Fake OpenAI API for load tests.")
+parser.add_argument("--port", type=int, default=8100)
+parser.add_argument("--latency-ms", type=float, default=500, help="time before a response (or its first streamed token)")
+parser.add_argument("--jitter-ms", type=float, default=200, help="random extra latency, uniform between 0 and this")
+parser.add_argument("--embedding-latency-ms", type=float, default=100, help="time before an embeddings response")
+parser.add_argument("--token-delay-ms", type=float, default=5, help="time between streamed chunks")
+parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500 error")
+parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with a 429 error")
+parser.add_argument("--deny-rate", type=float, default=0.0, help="share of second judge reviews that deny the ruling")
+parser.add_argument("--dims", type=int, default=3072, help="embedding dimensions (3072 like text-embedding-3-large)")
+args = parser.parse_args()
+
+app = Flask(__name__)
+
+RULING = {
+    "question": "Canned question from the fake OpenAI server.",
+    "short_answer": "Yes, this is a canned answer from the fake OpenAI server.",
+    "full_explanation": "The fake OpenAI server always gives this explanation.",
+    "sources": "702.19b Trample",
+    "single_word_answer": "yes"
+}
+
+# -------- HELPER FAKE LATENCY --------
+def fake_latency(latency_ms):
+    time.sleep((latency_ms + random.uniform(0, args.jitter_ms)) / 1000)
+
+# -------- HELPER FAKE ERROR --------
+def fake_error():
+    """Random 429/500 error response (like the OpenAI API sends them), or None."""
+    roll = random.random()
+    if roll < args.rate_limit_rate:
+        body = {"error": {"message": "Rate limit reached (fake).", "type": "requests", "code": "rate_limit_exceeded"}}
+        return Response(json.dumps(body), status=429, mimetype="application/json", headers={"retry-after": "1"})
+    if roll < args.rate_limit_rate + args.error_rate:
+        body = {"error": {"message": "The server had an error (fake).", "type": "server_error", "code": None}}
+        return Response(json.dumps(body), status=500, mimetype="application/json")
+    return None
+
+# -------- HELPER TOKENS --------
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+# -------- HELPER CANNED REPLY --------
+def canned_reply(body):
+    """Pick a reply that fits the pipeline stage of the request, from the messages and response format."""
+    messages = body.get("messages", [])
+    system = messages[0]["content"] if messages else ""
+    prompt = messages[-1]["content"] if messages else ""
+
+    if body.get("response_format", {}).get("type") == "json_object":
+        return json.dumps(RULING)
+
+    if "high judge" in system:
+        return "Denied, the ruling needs more context about the stack (fake)." if random.random() < args.deny_rate else "Accepted"
+
+    match = re.search(r"Original Question: (.*)", prompt)
+    question = match.group(1).strip() if match else "this interaction"
+    amount = 5 if "most relevant" in prompt else 10
+    topics = ["the stack", "priority", "combat damage", "triggered abilities", "state-based actions", "trample", "summoning sickness", "protection", "turn structure", "replacement effects"]
+    return "\n".join(f"{i + 1}. How do {topic} apply to: {question}" for i, topic in enumerate(topics[:amount]))
+
+# -------- CHAT COMPLETIONS --------
+@app.post("/v1/chat/completions")
+def chat_completions():
+    body = request.get_json()
+    fake_latency(args.latency_ms)
+    error = fake_error()
+    if error is not None:
+        return error
+
+    content = canned_reply(body)
+    usage = {
+        "prompt_tokens": sum(count_tokens(m.get("content") or "") for m in body.get("messages", [])),
+        "completion_tokens": count_tokens(content)
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        }
+
+    def generate():
+        def chunk(choices, **extra):
+            return "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model"), "choices": choices, **extra}) + "\n\n"
+
+        for i in range(0, len(content), 16):
+            yield chunk([{"index": 0, "delta": {"content": content[i:i + 16]}, "finish_reason": None}])
+            time.sleep(args.token_delay_ms / 1000)
+        yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield chunk([], usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+# -------- EMBEDDINGS --------
+@app.post("/v1/embeddings")
+def embeddings():
+    body = request.get_json()
+    fake_latency(args.embedding_latency_ms)
+    error = fake_error()
+    if error is not None:
+        return error
+
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    data = []
+    for i, text in enumerate(texts):
+        # same text, same vector: seeded by the text hash
+        seed = int.from_bytes(hashlib.sha1(str(text).encode("utf-8")).digest()[:8], "little")
+        vec = np.random.default_rng(seed).standard_normal(args.dims).astype(np.float32)
+        vec /= np.linalg.norm(vec)
+        embedding = base64.b64encode(vec.tobytes()).decode("ascii") if body.get("encoding_format") == "base64" else vec.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+    tokens = sum(count_tokens(str(t)) for t in texts)
+    return {"object": "list", "data": data, "model": body.get("model"), "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+if __name__ == "__main__":
+    print(f"Fake OpenAI API on http://localhost:{args.port}/v1 (latency {args.latency_ms} ms, errors {args.error_rate}, rate limits {args.rate_limit_rate})")
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
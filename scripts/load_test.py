@@ -0,0 +1,91 @@
+# drive the running API with concurrent /ask and /cards requests and report throughput, p50/p99 latency and error rate
+# use with scripts/fake_openai_server.py (OPENAI_BASE_URL=http://localhost:8100/v1) to load test without API costs
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description="Load test the MTG Judge API.")
+parser.add_argument("--url", default="http://localhost:5005", help="base URL of the API")
+parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at the same time")
+parser.add_argument("--duration", type=float, default=30, help="seconds to keep sending requests")
+parser.add_argument("--ask-share", type=float, default=0.2, help="share of requests that go to /ask, the rest go to /cards")
+parser.add_argument("--questions", default="data/easy-questions.json", help="question file with [{'text'}] used for /ask")
+parser.add_argument("--unique", action="store_true", help="make every question unique, so the answer cache never hits")
+parser.add_argument("--timeout", type=float, default=120, help="seconds before a request counts as failed")
+args = parser.parse_args()
+
+if os.path.exists(args.questions):
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [q["text"] for q in json.load(f)]
+else:
+    questions = ["Can a creature with trample assign combat damage to the player if it is blocked?"]
+
+PREFIXES = ["a", "li", "ser", "dra", "gob", "sh", "el", "bo"]
+
+# -------- HELPER REQUEST --------
+def send(method, path, body=None, headers=None):
+    """Send a request. Returns (status, seconds); status is None if the request failed without a response."""
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(args.url + path, data=data, method=method, headers={"Content-Type": "application/json", **(headers or {})})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return status, time.perf_counter() - start
+
+# -------- HELPER PICK REQUEST --------
+def pick_request(n):
+    """Next request of the mix: (endpoint name, method, path, body, headers)."""
+    if random.random() < args.ask_share:
+        question = random.choice(questions)
+        if args.unique:
+            question = f"{question} (load test {n})"
+        return "/ask", "POST", "/ask", {"question": question, "cards": []}, None
+
+    if random.random() < 0.5:
+        return "/cards?prefix", "GET", f"/cards?prefix={random.choice(PREFIXES)}&limit=20", None, None
+    return "/cards", "GET", "/cards", None, {"Accept-Encoding": "gzip"}
+
+# -------- RUN --------
+results = defaultdict(list) # endpoint -> [(status, seconds)]
+lock = threading.Lock()
+deadline = time.monotonic() + args.duration
+counter = iter(range(10 ** 9))
+
+def worker():
+    while time.monotonic() < deadline:
+        with lock:
+            n = next(counter)
+        name, method, path, body, headers = pick_request(n)
+        status, seconds = send(method, path, body, headers)
+        with lock:
+            results[name].append((status, seconds))
+
+print(f"Load testing {args.url} with {args.concurrency} concurrent clients for {args.duration:.0f}s ({args.ask_share:.0%} /ask)...")
+started = time.monotonic()
+with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+    for _ in range(args.concurrency):
+        pool.submit(worker)
+elapsed = time.monotonic() - started
+
+# -------- REPORT --------
+print(f"\n{'endpoint':<14} {'requests':>8} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'errors':>8}")
+for name, rows in sorted(results.items()) + [("all", [r for rows in results.values() for r in rows])]:
+    if not rows:
+        continue
+    latencies = [seconds * 1000 for _, seconds in rows]
+    errors = sum(1 for status, _ in rows if status is None or status >= 400)
+    print(f"{name:<14} {len(rows):>8} {len(rows) / elapsed:>8.1f} {np.percentile(latencies, 50):>9.1f} {np.percentile(latencies, 99):>9.1f} {errors / len(rows):>8.1%}")
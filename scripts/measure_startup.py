@@ -0,0 +1,61 @@
+# measure the startup of the server (import and preload time) and the memory of forked workers, like gunicorn runs them.
+# compare with --no-preload to see how much each worker saves by sharing the preloaded data (PSS, Linux only),
+# and with --no-freeze to see how much of it the garbage collector of the workers copies without gc.freeze()
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+parser = argparse.ArgumentParser(description="Measure server startup time and per-worker memory.")
+parser.add_argument("--workers", type=int, default=4, help="worker processes to fork")
+parser.add_argument("--no-preload", action="store_true", help="don't preload in the parent, every worker loads its own data")
+parser.add_argument("--no-freeze", action="store_true", help="preload without gc.freeze(), the workers' garbage collector copies the shared objects")
+args = parser.parse_args()
+
+started = time.perf_counter()
+import app # noqa: F401, imported like gunicorn does with preload_app
+from utils.state_utils import preload, after_fork, readiness, memory_usage, startup
+import_seconds = time.perf_counter() - started
+
+preload_seconds = 0
+if not args.no_preload:
+    started = time.perf_counter()
+    preload(freeze=not args.no_freeze)
+    preload_seconds = time.perf_counter() - started
+
+parent_memory = memory_usage()
+print(f"import: {import_seconds:.2f}s, preload: {preload_seconds:.2f}s, parent RSS {parent_memory['rss'] / 2**20:.0f} MB")
+
+# -------- WORKERS --------
+children = []
+for i in range(args.workers):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        after_fork()
+        started = time.perf_counter()
+        ready, checks = readiness()
+        gc.collect() # a full collection, like a worker runs sooner or later while serving
+        ready_seconds = time.perf_counter() - started
+        time.sleep(1) # wait for the other workers, so the shared pages are counted between all of them
+        report = {"ready": ready, "checks": checks, "ready_seconds": ready_seconds, "components": startup["components"], "memory": memory_usage()}
+        with os.fdopen(write_fd, "w") as f:
+            json.dump(report, f)
+        os._exit(0)
+    os.close(write_fd)
+    children.append((pid, read_fd))
+
+print(f"\n{'worker':<8} {'ready':>6} {'ready s':>8} {'RSS MB':>8} {'PSS MB':>8}")
+for pid, read_fd in children:
+    with os.fdopen(read_fd, "r") as f:
+        report = json.load(f)
+    os.waitpid(pid, 0)
+    pss = report["memory"]["pss"]
+    print(f"{pid:<8} {str(report['ready']):>6} {report['ready_seconds']:>8.2f} {report['memory']['rss'] / 2**20:>8.0f} {(pss / 2**20 if pss else float('nan')):>8.0f}")
+    if not report["ready"]:
+        print("  ", report["checks"])
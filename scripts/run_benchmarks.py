@@ -0,0 +1,225 @@
+# run the benchmark questions (data/*-questions.json) through answer_with_subqueries on a pool of workers
+# --record saves every chat and embedding response to a fixture, --replay answers from it offline and deterministically
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import numpy as np
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils import llm_utils, embedding_utils
+from utils.config_utils import EMBED_MODEL, EMBED_CACHE_MAX_ITEMS
+from utils.card_utils import get_card_store
+from utils.embedding_utils import EmbeddingCache
+from utils.model_utils import answer_with_subqueries
+from utils.mode_utils import resolve_mode
+
+DEFAULT_QUESTIONS = ["data/easy-questions.json", "data/hard-questions.json", "data/extra-questions.json"]
+
+parser = argparse.ArgumentParser(description="Accuracy and latency benchmark of the answer pipeline.")
+parser.add_argument("--questions", nargs="+", default=DEFAULT_QUESTIONS, help="question files with [{'text', 'answer'}]")
+parser.add_argument("--workers", type=int, default=4, help="questions answered at the same time")
+parser.add_argument("--limit", type=int, default=None, help="only the first N questions")
+parser.add_argument("--mode", choices=["fast", "balanced", "thorough", "auto"], default=None, help="execution mode of every question (default: DEFAULT_ASK_MODE)")
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument("--record", metavar="FIXTURE", help="save every chat and embedding response to this file")
+mode.add_argument("--replay", metavar="FIXTURE", help="answer from a recorded fixture, without calling the API")
+parser.add_argument("--output", help="write every question with its response and timings to this JSON file")
+args = parser.parse_args()
+
+# -------- HELPER REQUEST KEY --------
+def request_key(kwargs):
+    """Fixture key of a chat request: hash of all its arguments."""
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True).encode("utf-8")).hexdigest()
+
+def embedding_key(model, text):
+    """Fixture key of one embedded text."""
+    return hashlib.sha1(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+# -------- BENCHMARK CLIENT --------
+class BenchmarkClient:
+    """
+    Stands in for the OpenAI client (llm_utils.client). Counts tokens per worker thread, and either calls the real client
+    (recording the responses if a fixture is given) or replays the responses of a fixture.
+    """
+
+    def __init__(self, client=None, fixture=None):
+        self.client = client # None: replay only
+        self.fixture = fixture if fixture is not None else {"chat": {}, "embeddings": {}}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def tokens(self):
+        """Tokens used by the current thread since the last reset_tokens()."""
+        return getattr(self._local, "tokens", 0)
+
+    def reset_tokens(self):
+        self._local.tokens = 0
+
+    def _count(self, tokens):
+        self._local.tokens = self.tokens() + tokens
+
+    def _chat(self, timeout=None, **kwargs):
+        if kwargs.get("stream"):
+            raise ValueError("The benchmark runs answer_with_subqueries, streamed completions are not supported.")
+
+        # identical requests get the recorded response, so a recorded run and its replays follow the same path
+        key = request_key(kwargs)
+        with self._lock:
+            recorded = self.fixture["chat"].get(key)
+
+        if recorded is None:
+            if self.client is None:
+                raise KeyError(f"Chat request {key} is not in the fixture, record it again with --record.")
+            resp = self.client.chat.completions.create(timeout=timeout, **kwargs)
+            recorded = {
+                "content": resp.choices[0].message.content,
+                "prompt_tokens": resp.usage.prompt_tokens,
+                "completion_tokens": resp.usage.completion_tokens
+            }
+            with self._lock:
+                recorded = self.fixture["chat"].setdefault(key, recorded) # first response wins if two workers raced
+
+        self._count(recorded["prompt_tokens"] + recorded["completion_tokens"])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=recorded["content"]))],
+            usage=SimpleNamespace(prompt_tokens=recorded["prompt_tokens"], completion_tokens=recorded["completion_tokens"], prompt_tokens_details=None)
+        )
+
+    def _embed(self, model, input, timeout=None):
+        keys = [embedding_key(model, text) for text in input]
+        if self.client is None:
+            missing = [text for key, text in zip(keys, input) if key not in self.fixture["embeddings"]]
+            if missing:
+                raise KeyError(f"{len(missing)} texts are not in the fixture (e.g. {missing[0]!r}), record it again with --record.")
+            vectors = [self.fixture["embeddings"][key] for key in keys]
+            tokens = sum(len(text) // 4 + 1 for text in input) # estimate, the fixture only keeps the vectors
+        else:
+            resp = self.client.embeddings.create(model=model, input=input, timeout=timeout)
+            vectors = [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+            tokens = resp.usage.total_tokens
+            with self._lock:
+                self.fixture["embeddings"].update(zip(keys, vectors))
+
+        self._count(tokens)
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=vec) for i, vec in enumerate(vectors)],
+            usage=SimpleNamespace(total_tokens=tokens)
+        )
+
+# -------- HELPER FIND CARDS --------
+def find_cards(text):
+    """Cards named between brackets in a question ("[Lightning Bolt]"), looked up by name in the card store."""
+    cards_info = []
+    for card_name in dict.fromkeys(re.findall(r'\[([^\]]+)\]', text)):
+        card = get_card_store().get_by_name(card_name)
+        if card is not None:
+            cards_info.append(card)
+        else:
+            print(f"Card {card_name} not found in database!")
+    return cards_info
+
+# -------- HELPER BUCKET --------
+def bucket(question, response):
+    """Accuracy bucket of a response: correct, denied (judge conflict), unclear, incorrect or error."""
+    if "single_word_answer" not in response:
+        return "error"
+
+    gold = question["answer"].strip().lower()
+    pred = str(response["single_word_answer"]).strip().lower()
+    if pred == "depends":
+        pred = "yes" # asume depends means yes for the sake of this benchmark
+
+    if pred == gold:
+        return "correct"
+    if pred in ("denied", "unclear"):
+        return pred
+    return "incorrect"
+
+# -------- RUN --------
+questions = []
+for path in args.questions:
+    with open(path, "r", encoding="utf-8") as f:
+        questions.extend(json.load(f))
+questions = questions[:args.limit]
+
+if args.replay:
+    with open(args.replay, "r", encoding="utf-8") as f:
+        client = BenchmarkClient(fixture=json.load(f))
+else:
+    client = BenchmarkClient(client=llm_utils.get_client())
+llm_utils.client = client
+llm_utils.embed_hedge_after = None # hedged requests run on other threads, outside the per-thread token counts
+
+if args.record or args.replay:
+    # a fresh embedding cache, so every embedding of the run goes through the fixture
+    tmp_dir = tempfile.mkdtemp(prefix="mtg-benchmark-")
+    embedding_utils.embedding_cache = EmbeddingCache(os.path.join(tmp_dir, "embeddings.sqlite3"), EMBED_CACHE_MAX_ITEMS, EMBED_MODEL)
+
+def run_question(i, question):
+    client.reset_tokens()
+    start = time.perf_counter()
+    cards_info = find_cards(question["text"])
+    ask_mode, _ = resolve_mode(question["text"], cards_info, args.mode)
+    try:
+        response = answer_with_subqueries(question["text"], cards_info, ask_mode)
+    except Exception as e:
+        response = {"error": f"{type(e).__name__}: {e}"}
+    return {
+        "index": i,
+        "question": question,
+        "mode": ask_mode,
+        "response": response,
+        "bucket": bucket(question, response),
+        "seconds": time.perf_counter() - start,
+        "tokens": client.tokens()
+    }
+
+print(f"Running {len(questions)} questions with {args.workers} workers{' (replay)' if args.replay else ''}...")
+started = time.perf_counter()
+results = []
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    futures = [pool.submit(run_question, i, q) for i, q in enumerate(questions)]
+    for future in as_completed(futures):
+        result = future.result()
+        results.append(result)
+        print(f"[{len(results)}/{len(questions)}] {result['bucket']:<9} {result['mode']:<8} {result['seconds']:6.1f}s  {result['question']['text'][:70]}")
+elapsed = time.perf_counter() - started
+results.sort(key=lambda r: r["index"])
+
+# -------- REPORT --------
+total = len(results)
+print(f"\nFinished in {elapsed / 60:.1f} minutes")
+for name in ("correct", "denied", "unclear", "incorrect", "error"):
+    print(f"{name} answers: {sum(r['bucket'] == name for r in results)}/{total}")
+
+if results:
+    seconds = [r["seconds"] for r in results]
+    tokens = [r["tokens"] for r in results]
+    print(f"latency per question: p50 {np.percentile(seconds, 50):.1f}s, p95 {np.percentile(seconds, 95):.1f}s")
+    print(f"tokens per question: mean {np.mean(tokens):.0f}, p50 {np.percentile(tokens, 50):.0f}, p95 {np.percentile(tokens, 95):.0f}")
+
+for r in results:
+    if r["bucket"] in ("incorrect", "error"):
+        print("-------------------------")
+        print("original question:", r["question"]["text"])
+        print("correct answer: ", r["question"]["answer"])
+        print("response: ", r["response"].get("short_answer", r["response"]))
+
+if args.record:
+    with open(args.record, "w", encoding="utf-8") as f:
+        json.dump(client.fixture, f)
+    print(f"\nRecorded {len(client.fixture['chat'])} chat and {len(client.fixture['embeddings'])} embedding responses to {args.record}")
+
+if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
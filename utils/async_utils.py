@@ -0,0 +1,243 @@
+# -------- IMPORTS --------
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future
+
+# -------- CONFIG --------
+from utils.config_utils import CHAT_MODEL, MAX_SUBQUERIES, MODEL_HIGH_TEMPERATURE, MODEL_LOW_TEMPERATURE, REFINEMENT_CONTEXT_TOKEN_BUDGET, HYBRID_SEARCH, ASK_MODES
+from utils.model_utils import (
+    get_rules_index, collect_results, retrieve_card_rulings, needs_ruling_narrowing, safe_json_parse, subqueries_prompt, select_subqueries_prompt,
+    subquery_messages, parse_subqueries, judge_messages_for, judge2_messages_for, refinement_messages_for
+)
+from utils.embedding_utils import aembed_texts
+from utils.lexical_utils import only_rule_references
+from utils.context_utils import select_context, assemble_context, reference_chunks
+from utils.llm_utils import achat
+from utils.metrics_utils import metrics, span
+
+# Event loop of the concurrent pipeline, started on first use in each process
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+# -------- HELPER EVENT LOOP --------
+def get_event_loop():
+    """
+    Return the event loop every concurrent pipeline runs on, running in a daemon thread.
+    A single long-lived loop lets the async OpenAI client reuse its connections between requests.
+    """
+    global _loop, _loop_pid
+
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid(): # a forked worker doesn't have the thread of its parent's loop
+            _loop, _loop_pid = asyncio.new_event_loop(), os.getpid()
+            threading.Thread(target=_loop.run_forever, name="async-pipeline", daemon=True).start()
+    return _loop
+
+# -------- HELPER RUN COROUTINE --------
+def run_coroutine(coro):
+    """
+    Run a coroutine on the pipeline event loop from regular (thread) code and wait for its result.
+    It runs in a copy of the caller's context, so its spans still go to the caller's request timings.
+    """
+    loop = get_event_loop()
+    ctx = contextvars.copy_context()
+    future = Future()
+
+    def done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        task = ctx.run(loop.create_task, coro) # the task copies the current context, here the caller's
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future.result()
+
+# -------- HELPER PREFETCH EMBEDDINGS --------
+async def prefetch_embeddings(texts):
+    """
+    Embed the texts with the async client, so the (thread) searches that follow find them in the embedding cache.
+    Queries that only name rules are left out, the hybrid search doesn't embed them.
+    """
+    texts = [t.strip() for t in texts if t.strip() and not (HYBRID_SEARCH and only_rule_references(t))]
+    if texts:
+        await aembed_texts(texts)
+
+# -------- HELPER ASYNC COLLECT RESULTS --------
+async def acollect_results(subqueries, top_k):
+    """collect_results with the embeddings created on the event loop and the index search in a thread."""
+    await prefetch_embeddings(subqueries)
+    return await asyncio.to_thread(collect_results, subqueries, top_k)
+
+# -------- HELPER JUDGE CONTEXT --------
+def judge_context(results, cards_info, settings):
+    """
+    select_context and assemble_context of the first judge call, with the rules the chunks cite.
+    CPU bound (tokenizing and counting every chunk), so the pipeline runs it in a thread, off the event loop.
+    """
+    chunks = select_context(results, settings["max_content_chunks"])
+    rules_index = get_rules_index()
+    return assemble_context(chunks + reference_chunks(chunks, rules_index), cards_info, settings["context_token_budget"], rules_index.golden_rules)
+
+# -------- HELPER REFINEMENT CONTEXT --------
+def refinement_context(results, settings, exclude_ids):
+    """select_context and assemble_context of the refinement call, without the chunks the judge already has. Run in a thread too."""
+    chunks = select_context(results, settings["max_content_chunks"], exclude_ids=exclude_ids)
+    return assemble_context(chunks, [], REFINEMENT_CONTEXT_TOKEN_BUDGET)
+
+# -------- HELPER ASYNC GENERATE SUBQUERIES --------
+async def agenerate_subqueries(query, max_subqueries=MAX_SUBQUERIES, select=True, stage="subqueries"):
+    """Same as generate_subqueries, with the async client. The stage names the calls in the token usage."""
+    amount = max_subqueries * 2 if select else max_subqueries
+    text = await achat(
+        stage,
+        model=CHAT_MODEL,
+        temperature=MODEL_HIGH_TEMPERATURE,
+        messages=subquery_messages(subqueries_prompt(query, amount))
+    )
+    subqueries = parse_subqueries(text)
+
+    if not select:
+        return subqueries[:max_subqueries]
+
+    if len(subqueries) > max_subqueries:
+        text2 = await achat(
+            f"{stage}_select",
+            model=CHAT_MODEL,
+            temperature=MODEL_HIGH_TEMPERATURE,
+            messages=subquery_messages(select_subqueries_prompt(query, subqueries, max_subqueries))
+        )
+        subqueries = parse_subqueries(text2)
+
+    return subqueries
+
+# -------- HELPER DISCARD TASK --------
+def discard_task(task):
+    """
+    Cancel a task whose result isn't needed anymore, and retrieve its exception once it finishes. A task that fails
+    while unwinding from the cancel (e.g. in the HTTP client's cleanup) would otherwise be logged by asyncio as
+    "Task exception was never retrieved", since nothing awaits it.
+    """
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+# -------- HELPER PREFETCH REFINEMENT --------
+async def prefetch_refinement(judge1_answer, settings):
+    """
+    Speculative refinement context, run while the second judge reviews the ruling:
+    subqueries of the first ruling (no selection call) and their chunks. Returns (subqueries, results).
+    """
+    subqueries = await agenerate_subqueries(judge1_answer, settings["max_subqueries"], select=False, stage="speculative_subqueries")
+    return subqueries, await acollect_results(subqueries, settings["top_k"])
+
+# ---------- ASYNC ANSWER WITH SUBQUERIES ----------
+async def aanswer_with_subqueries(user_prompt, cards_info, mode="thorough"):
+    """
+    Concurrent version of answer_with_subqueries, with the same JSON output:
+
+    - the rules search and the card rulings lookup run at the same time, after one embeddings call for both
+    - while the second judge reviews the first ruling, the refinement context is prefetched from the ruling
+    - on "Accepted" the prefetch is cancelled; on a denial only the judge feedback itself still has to be searched,
+      instead of generating new subqueries from it after the review
+    """
+    settings = ASK_MODES[mode]
+
+    # Step 1: Generate subqueries
+    with span("mtg_stage_seconds", stage="subqueries"):
+        subqueries = await agenerate_subqueries(user_prompt, settings["max_subqueries"], settings["select_subqueries"])
+
+    # Step 2: Rules chunks and card rulings at the same time
+    with span("mtg_stage_seconds", stage="retrieval"):
+        await prefetch_embeddings(subqueries + ([user_prompt] if needs_ruling_narrowing(cards_info) else []))
+        all_results, cards_info = await asyncio.gather(
+            asyncio.to_thread(collect_results, subqueries, settings["top_k"]),
+            asyncio.to_thread(retrieve_card_rulings, user_prompt, subqueries, cards_info)
+        )
+
+    with span("mtg_stage_seconds", stage="context"):
+        assembled = await asyncio.to_thread(judge_context, all_results, cards_info, settings)
+        all_results = assembled["chunks"]
+
+    judge_messages = judge_messages_for(user_prompt, assembled)
+
+    # Initial judge call
+    with span("mtg_stage_seconds", stage="judge1"):
+        judge1_answer = await achat(
+            "judge1",
+            model=CHAT_MODEL,
+            temperature=MODEL_LOW_TEMPERATURE,
+            messages=judge_messages,
+            response_format={"type": "json_object"}
+        )
+
+    # Fast mode: judge 1 ruling without review
+    if not settings["second_judge"]:
+        return safe_json_parse(judge1_answer)
+
+    # ---------- SECONDARY JUDGE, WITH SPECULATIVE REFINEMENT CONTEXT ----------
+    prefetch = asyncio.create_task(prefetch_refinement(judge1_answer, settings))
+    try:
+        with span("mtg_stage_seconds", stage="judge2"):
+            judge2_response = (await achat(
+                "judge2",
+                model=CHAT_MODEL,
+                temperature=MODEL_HIGH_TEMPERATURE,
+                messages=judge2_messages_for(user_prompt, assembled, judge1_answer)
+            )).strip()
+    except BaseException:
+        discard_task(prefetch)
+        raise
+
+    accepted = judge2_response.startswith("Accepted")
+    metrics.inc("mtg_judge_verdicts_total", verdict="accepted" if accepted else "denied")
+
+    # ---------- ACCEPTED CASE ----------
+    if accepted:
+        discard_task(prefetch)
+        metrics.inc("mtg_speculation_total", outcome="wasted")
+        return safe_json_parse(judge1_answer)
+
+    # ---------- DENIED CASE ----------
+    print("2nd judge conflict")
+    with span("mtg_stage_seconds", stage="refinement_context"):
+        feedback_results, prefetched = await asyncio.gather(
+            acollect_results([judge2_response], settings["top_k"]),
+            prefetch,
+            return_exceptions=True
+        )
+        if isinstance(feedback_results, BaseException):
+            raise feedback_results
+        if isinstance(prefetched, BaseException):
+            print(f"Refinement prefetch failed: {prefetched}")
+            metrics.inc("mtg_speculation_total", outcome="failed")
+            prefetched = ([], [])
+        else:
+            metrics.inc("mtg_speculation_total", outcome="used")
+
+        # Keep within limits, without the chunks the judge already has. The cards are already in the conversation.
+        refined = await asyncio.to_thread(refinement_context, feedback_results + prefetched[1], settings, [r["id"] for r in all_results])
+
+    #* Loop back to initial judge
+    with span("mtg_stage_seconds", stage="refinement"):
+        refined_answer = await achat(
+            "refinement",
+            model=CHAT_MODEL,
+            temperature=MODEL_LOW_TEMPERATURE,
+            messages=refinement_messages_for(judge_messages, judge1_answer, judge2_response, refined["context"]),
+            response_format={"type": "json_object"}
+        )
+
+    return safe_json_parse(refined_answer)
+
+# ---------- ANSWER WITH SUBQUERIES CONCURRENT ----------
+def answer_with_subqueries_concurrent(user_prompt, cards_info, mode="thorough"):
+    """Run aanswer_with_subqueries from regular (thread) code, e.g. a Flask view. Same output as answer_with_subqueries."""
+    return run_coroutine(aanswer_with_subqueries(user_prompt, cards_info, mode))
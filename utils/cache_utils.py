@@ -0,0 +1,132 @@
+# -------- IMPORTS --------
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# -------- CONFIG --------
+from utils import config_utils
+from utils.config_utils import ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ITEMS
+
+# Settings that change the answer. A cached answer is only reused while all of them are the same.
+ANSWER_SETTINGS = ["CHAT_MODEL", "EMBED_MODEL", "MODEL_HIGH_TEMPERATURE", "MODEL_LOW_TEMPERATURE", "TOP_K", "MAX_SUBQUERIES", "MAX_CONTENT_CHUNKS", "ASK_MODES"]
+
+# -------- HELPER SETTINGS HASH --------
+def settings_hash():
+    """Hash of the config_utils settings in ANSWER_SETTINGS."""
+    settings = {name: getattr(config_utils, name) for name in ANSWER_SETTINGS}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+# -------- HELPER ANSWER CACHE KEY --------
+def answer_cache_key(question, cards_info, mode="thorough"):
+    """Cache key of an /ask request: normalized question, sorted card uuids, the mode and the answer settings."""
+    normalized = re.sub(r"\s+", " ", question.strip().lower())
+    uuids = sorted(c.get("uuid", "") for c in cards_info)
+    raw = json.dumps([normalized, uuids, mode, settings_hash()])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+# -------- ANSWER CACHE --------
+class AnswerCache:
+    """
+    TTL + LRU cache of final /ask answers with in-flight request coalescing.
+
+    When several identical requests arrive at the same time, only the first one runs
+    the pipeline; the others wait for its result instead of starting their own.
+    Each worker process has its own cache, so coalescing only joins requests that reach the same worker.
+    """
+
+    def __init__(self, ttl_seconds, max_items):
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._items = OrderedDict() # key -> (expires_at, value), most recently used last
+        self._inflight = {} # key -> Future shared by every request waiting on that key
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get(self, key):
+        """Return the live cached value for key or None. Caller must hold the lock."""
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, value):
+        """Store value for key and evict the least recently used entries. Caller must hold the lock."""
+        self._items[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value computed outside of get_or_compute (e.g. by a streamed request)."""
+        with self._lock:
+            self._put(key, value)
+
+    def get_or_compute(self, key, compute, should_cache=lambda value: True):
+        """
+        Return the cached value for key, or compute it once for all concurrent callers.
+
+        Args:
+            key (str): The cache key.
+            compute (callable): Function with no arguments that computes the value.
+            should_cache (callable): Decides if a computed value is stored (e.g. skip errors).
+
+        Returns:
+            The cached or computed value. Exceptions of compute are raised to every waiting caller.
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            if should_cache(value):
+                self._put(key, value)
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        """Hit/miss/coalesced counters since startup."""
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "items": len(self._items)}
+
+# Create the cache once (outside function, at server startup)
+answer_cache = AnswerCache(ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ITEMS)
@@ -0,0 +1,434 @@
+# -------- IMPORTS --------
+import os
+import re
+import json
+import gzip
+import bisect
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+try:
+    import brotli # optional, enables pre-compressed "br" catalog responses
+except ImportError:
+    brotli = None
+
+# -------- CONFIG --------
+from utils.config_utils import CARDS_FILE, CARDS_DB_FILE
+
+# -------- HELPER NORMALIZE NAME --------
+def normalize_name(name):
+    """Normalize a card name for lookups (case and whitespace insensitive)."""
+    return re.sub(r"\s+", " ", (name or "").strip().lower())
+
+# -------- HELPER NAME TOKENS --------
+NAME_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+")
+
+def name_tokens(text):
+    """
+    Words of a text for card name matching, with their original spelling: accents folded, apostrophes dropped
+    ("Thassa's" -> "Thassas") and any other punctuation as a separator ("Jace, the Mind Sculptor", "Fire // Ice").
+    """
+    folded = unicodedata.normalize("NFKD", text.replace("Æ", "Ae").replace("æ", "ae")).encode("ascii", "ignore").decode("ascii")
+    return NAME_TOKEN_PATTERN.findall(folded.replace("'", ""))
+
+# -------- CARD NAME MATCHER --------
+class CardNameMatcher:
+    """
+    Token trie over all card names, to find the cards mentioned in a free-text question.
+
+    The question is scanned once: from each word the trie is walked as far as it goes and the
+    longest card name wins (leftmost-longest, non-overlapping), so the time is linear in the
+    question length (times the word count of the longest name).
+    One word names ("Fog", "Flash", "Island") are also common words, so they only match when capitalized.
+    """
+
+    END = "" # trie key of the card at the end of a name (tokens are never empty)
+
+    def __init__(self, cards):
+        self.trie = {}
+        for name, uuid in cards:
+            node = self.trie
+            for token in name_tokens(name):
+                node = node.setdefault(token.lower(), {})
+            if node is not self.trie:
+                node.setdefault(self.END, (name, uuid)) # first card of a name wins, like the stores
+
+    def find(self, text):
+        """
+        Cards mentioned in a text, in order of appearance and without duplicates.
+
+        Returns:
+            list[tuple[str, str]]: (name, uuid) of each card found.
+        """
+        tokens = name_tokens(text)
+        lowered = [t.lower() for t in tokens]
+        found, i = {}, 0
+
+        while i < len(tokens):
+            node, match, j = self.trie, None, i
+            while j < len(tokens) and lowered[j] in node:
+                node = node[lowered[j]]
+                j += 1
+                if self.END in node and (j - i > 1 or tokens[i][0].isupper()):
+                    match = (node[self.END], j)
+
+            if match is None:
+                i += 1
+                continue
+
+            card, i = match
+            found.setdefault(card[1], card)
+
+        return list(found.values())
+
+# -------- CARD CATALOG --------
+class CardCatalog:
+    """The /cards list ({uuid, name, multiverseId}) serialized once, with pre-compressed bodies and an ETag."""
+
+    def __init__(self, cards):
+        card_list = [{"uuid": c.get("uuid", ""), "name": c.get("name", ""), "multiverseId": c.get("multiverseId", "")} for c in cards]
+        self.body = json.dumps({"cards": card_list}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+        # pre-compressed variants by content encoding
+        self.encoded = {"gzip": gzip.compress(self.body, compresslevel=9)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+
+# -------- CARD STORE --------
+class CardStore:
+    """
+    Resident, indexed view of the converted cards file.
+
+    The file is parsed once and kept in memory with uuid and normalized name
+    indexes, so lookups are O(1) instead of a json.load + linear scan per request.
+    The store reloads itself when the file changes on disk (checked by mtime). While one thread
+    reloads, the others keep reading the previous indexes, which are also kept if the new file fails to load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock() # held by the thread reloading, readers never wait on it
+        self._mtime = None
+        self._failed_mtime = None # mtime of a file that failed to load, not retried until it changes again
+        self._cards = []      # compact card dicts (None fields dropped)
+        self._by_uuid = {}    # uuid -> index in self._cards
+        self._by_name = {}    # normalized name -> index in self._cards
+        self._name_keys = []  # sorted (normalized name, index) for prefix search
+        self._word_keys = []  # sorted (name word, index) for word prefix search
+        self._catalog = None
+        self._matcher = None
+        self.reload_if_changed()
+
+    def _load(self, mtime):
+        """Parse the cards file and rebuild the indexes."""
+        with open(self.path, "r", encoding="utf-8") as f:
+            raw_cards = json.load(f)
+
+        cards, by_uuid, by_name, name_keys, word_keys = [], {}, {}, [], []
+        for card in raw_cards:
+            if "name" not in card:
+                continue
+            compact = {k: v for k, v in card.items() if v is not None}
+            idx = len(cards)
+            cards.append(compact)
+            if compact.get("uuid"):
+                by_uuid[compact["uuid"]] = idx
+
+            key = normalize_name(compact["name"])
+            by_name.setdefault(key, idx)
+            name_keys.append((key, idx))
+            for word in set(key.split(" ")[1:]): # first word is already covered by the name prefix
+                word_keys.append((word, idx))
+
+        name_keys.sort()
+        word_keys.sort()
+        catalog = CardCatalog(cards)
+
+        # swap all indexes at once so readers never see a half-built store
+        self._cards, self._by_uuid, self._by_name = cards, by_uuid, by_name
+        self._name_keys, self._word_keys, self._catalog = name_keys, word_keys, catalog
+        self._matcher = None
+        self._mtime = mtime
+        print(f"Loaded {len(cards)} cards into card store")
+
+    def reload_if_changed(self):
+        """
+        Reload the store if the cards file was modified since the last load. Returns True if reloaded.
+        Doesn't wait while another thread reloads (unless nothing is loaded yet), and keeps the current
+        indexes if the file can't be loaded (e.g. half written): it's tried again once its mtime changes.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._mtime is None:
+                print(f"Card file not found at {self.path}")
+            return False
+
+        if mtime in (self._mtime, self._failed_mtime):
+            return False
+
+        if not self._lock.acquire(blocking=self._mtime is None):
+            return False # another thread is reloading, serve the previous indexes meanwhile
+        try:
+            if mtime in (self._mtime, self._failed_mtime): # another thread already tried this file
+                return False
+            self._load(mtime)
+        except Exception as e:
+            self._failed_mtime = mtime
+            print(f"Loading {self.path} failed, keeping the previous cards: {type(e).__name__}: {e}")
+            return False
+        finally:
+            self._lock.release()
+        return True
+
+    def __len__(self):
+        return len(self._cards)
+
+    def get(self, uuid):
+        """Return the card with the given uuid, or None."""
+        idx = self._by_uuid.get(uuid)
+        return self._cards[idx] if idx is not None else None
+
+    def get_by_name(self, name):
+        """Return the card with the given name (case insensitive), or None."""
+        idx = self._by_name.get(normalize_name(name))
+        return self._cards[idx] if idx is not None else None
+
+    def all_cards(self):
+        """Return all cards in file order."""
+        return self._cards
+
+    def catalog(self):
+        """Return the precomputed CardCatalog for the full card list."""
+        if self._catalog is None:
+            self._catalog = CardCatalog([])
+        return self._catalog
+
+    def name_matcher(self):
+        """Return the CardNameMatcher of all card names, built on first use after each load."""
+        if self._matcher is None:
+            self._matcher = CardNameMatcher((c["name"], c.get("uuid", "")) for c in self._cards)
+        return self._matcher
+
+    def search(self, prefix, words=False, limit=20, cursor=0):
+        """
+        Autocomplete search over card names using the sorted name indexes.
+
+        Args:
+            prefix (str): Name prefix to match (case insensitive).
+            words (bool): Match the prefix against any word of the name instead of only its start.
+            limit (int): Max number of cards to return.
+            cursor (int): Position returned as next_cursor by the previous page.
+
+        Returns:
+            tuple[list[dict], int | None]: Matching {uuid, name, multiverseId} and the cursor of the next page.
+        """
+        prefix = normalize_name(prefix)
+        name_keys = self._name_keys
+        start = bisect.bisect_left(name_keys, (prefix,))
+
+        # a card can match both by name and by word, so keep a seen set across both ranges
+        ranges = [(name_keys, start)]
+        if words:
+            ranges.append((self._word_keys, bisect.bisect_left(self._word_keys, (prefix,))))
+
+        results, seen, position = [], set(), 0
+        for keys, start in ranges:
+            i = start
+            while i < len(keys) and keys[i][0].startswith(prefix):
+                idx = keys[i][1]
+                if position >= cursor and idx not in seen:
+                    if len(results) == limit:
+                        return results, position
+                    card = self._cards[idx]
+                    results.append({"uuid": card.get("uuid", ""), "name": card.get("name", ""), "multiverseId": card.get("multiverseId", "")})
+                seen.add(idx)
+                position += 1
+                i += 1
+
+        return results, None
+
+# -------- HELPER CREATE CARD TABLES --------
+def create_card_tables(db):
+    """Create the tables of a cards database (see scripts/convert-cards-data.py)."""
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS cards (
+            idx INTEGER PRIMARY KEY,  -- position in the source, first printing of each name
+            uuid TEXT,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL,   -- normalize_name(name)
+            multiverse_id TEXT,
+            data TEXT NOT NULL        -- the compact card JSON
+        );
+        CREATE TABLE IF NOT EXISTS card_words (
+            word TEXT NOT NULL,       -- every name word but the first one, for word prefix search
+            idx INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS cards_uuid ON cards (uuid);
+        CREATE INDEX IF NOT EXISTS cards_name_key ON cards (name_key);
+        CREATE INDEX IF NOT EXISTS card_words_word ON card_words (word);
+    """)
+
+# -------- SQLITE CARD STORE --------
+class SqliteCardStore:
+    """
+    Same interface as CardStore, over the SQLite cards database instead of the JSON file.
+
+    Cards are read from disk on demand (uuid, name and prefix lookups use the database indexes),
+    so only the /cards catalog is kept in memory. The database is reopened when the file changes,
+    like CardStore without blocking the readers and keeping the previous database if the new one fails to open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock() # the connection, held for each query
+        self._reload_lock = threading.Lock()
+        self._mtime = None
+        self._failed_mtime = None
+        self._db = None
+        self._pid = None
+        self._count = 0
+        self._catalog = None
+        self._matcher = None
+        self.reload_if_changed()
+
+    def _load(self, mtime):
+        """Open the database and rebuild the catalog."""
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT uuid, name, multiverse_id FROM cards ORDER BY idx").fetchall()
+        except sqlite3.Error:
+            db.close()
+            raise
+        catalog = CardCatalog([{"uuid": uuid or "", "name": name, "multiverseId": multiverse_id or ""} for uuid, name, multiverse_id in rows])
+
+        with self._lock:
+            old_db = self._db
+            self._db, self._pid, self._count, self._catalog = db, os.getpid(), len(rows), catalog
+            self._matcher = None
+            self._mtime = mtime
+        if old_db is not None:
+            old_db.close()
+        print(f"Opened {len(rows)} cards from card database")
+
+    def reload_if_changed(self):
+        """Reopen the database if the file was replaced since the last load. Returns True if reloaded."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            if self._mtime is None:
+                print(f"Card database not found at {self.path}")
+            return False
+
+        if mtime in (self._mtime, self._failed_mtime):
+            return False
+
+        if not self._reload_lock.acquire(blocking=self._mtime is None):
+            return False # another thread is reloading, serve the previous database meanwhile
+        try:
+            if mtime in (self._mtime, self._failed_mtime): # another thread already tried this file
+                return False
+            self._load(mtime)
+        except Exception as e:
+            self._failed_mtime = mtime
+            print(f"Opening {self.path} failed, keeping the previous cards: {type(e).__name__}: {e}")
+            return False
+        finally:
+            self._reload_lock.release()
+        return True
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            if self._db is None:
+                return []
+            if self._pid != os.getpid(): # forked worker: its own connection, the catalog is shared with the parent
+                self._db, self._pid = self._connect(), os.getpid()
+            return self._db.execute(sql, params).fetchall()
+
+    def __len__(self):
+        return self._count
+
+    def get(self, uuid):
+        """Return the card with the given uuid, or None."""
+        rows = self._query("SELECT data FROM cards WHERE uuid = ? ORDER BY idx LIMIT 1", (uuid,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_by_name(self, name):
+        """Return the card with the given name (case insensitive), or None."""
+        rows = self._query("SELECT data FROM cards WHERE name_key = ? ORDER BY idx LIMIT 1", (normalize_name(name),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def all_cards(self):
+        """Yield all cards in source order, one database page at a time."""
+        last = -1
+        while True:
+            rows = self._query("SELECT idx, data FROM cards WHERE idx > ? ORDER BY idx LIMIT 1000", (last,))
+            if not rows:
+                return
+            for idx, data in rows:
+                yield json.loads(data)
+            last = rows[-1][0]
+
+    def catalog(self):
+        """Return the precomputed CardCatalog for the full card list."""
+        if self._catalog is None:
+            self._catalog = CardCatalog([])
+        return self._catalog
+
+    def name_matcher(self):
+        """Return the CardNameMatcher of all card names, built on first use after each load."""
+        if self._matcher is None:
+            self._matcher = CardNameMatcher(self._query("SELECT name, uuid FROM cards ORDER BY idx"))
+        return self._matcher
+
+    def search(self, prefix, words=False, limit=20, cursor=0):
+        """Autocomplete search over card names, like CardStore.search (name matches first, then word matches)."""
+        prefix = normalize_name(prefix)
+        upper = prefix + "\uffff"
+
+        sql = "SELECT idx, 0 AS part, name_key AS k FROM cards WHERE name_key >= ? AND name_key < ?"
+        params = [prefix, upper]
+        if words:
+            sql += " UNION ALL SELECT idx, 1, word FROM card_words WHERE word >= ? AND word < ?"
+            params += [prefix, upper]
+
+        # a card can match both by name and by word, grouping keeps its first match
+        rows = self._query(f"""
+            SELECT c.uuid, c.name, c.multiverse_id
+            FROM ({sql}) m JOIN cards c ON c.idx = m.idx
+            GROUP BY m.idx
+            ORDER BY MIN(m.part || ':' || m.k), m.idx
+            LIMIT ? OFFSET ?
+        """, params + [limit + 1, cursor])
+
+        results = [{"uuid": uuid or "", "name": name, "multiverseId": multiverse_id or ""} for uuid, name, multiverse_id in rows[:limit]]
+        return results, (cursor + limit if len(rows) > limit else None)
+
+# -------- HELPER OPEN CARD STORE --------
+def open_card_store():
+    """The SQLite card store if the cards database exists, otherwise the resident store of the JSON cards file."""
+    if os.path.exists(CARDS_DB_FILE):
+        return SqliteCardStore(CARDS_DB_FILE)
+    return CardStore(CARDS_FILE)
+
+# Card store, opened on first use (or before the workers fork, see utils/state_utils.py).
+# Not at import: scripts that only need the helpers above (e.g. convert-cards-data.py) don't load the cards.
+card_store = None
+card_store_lock = threading.Lock()
+
+# -------- HELPER GET CARD STORE --------
+def get_card_store():
+    """Return the card store, opening it on first use."""
+    global card_store
+
+    if card_store is None:
+        with card_store_lock:
+            if card_store is None: # another thread may have opened it meanwhile
+                card_store = open_card_store()
+    return card_store
@@ -1,25 +1,47 @@
 import os
-from openai import OpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # GENERAL VARIABLES
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None # e.g. http://localhost:8100/v1 for scripts/fake_openai_server.py. None: the OpenAI API.
 
 # DIST VARIABLES
 RULES_FILE = "./data/comprehensive-rules.txt"
 # CARDS_FILE = "./data/clean-standard-cards.json"
 CARDS_FILE = "./data/clean-all-printings.json"
+CARDS_DB_FILE = "./data/cards.sqlite3" # cards database written by scripts/convert-cards-data.py. Used instead of CARDS_FILE when it exists.
+CARDS_SEARCH_LIMIT = 20 # default amount of cards returned by /cards?prefix= autocomplete
+CARDS_SEARCH_MAX_LIMIT = 100 # max amount of cards a client can request per autocomplete page
+AUTO_DETECT_CARDS = True # find the cards named in the /ask question and add them to the selected ones.
+AUTO_DETECT_MAX_CARDS = 5 # max cards added from the question text.
 
 # EMBEDINGS MODEL VARIABLES
 EMBED_MODEL = "text-embedding-3-large" # OpenAI’s most accurate embedding model.
 CHROMA_DB_DIR = os.path.join(os.getcwd(), "chroma_db")
+COLLECTION_NAME = "mtg_data" # prefix of the rules collections. Each build creates a new "mtg_data_<timestamp>" collection.
+ACTIVE_COLLECTION_FILE = os.path.join(CHROMA_DB_DIR, "active_collection") # holds the name of the collection the server queries
+CARD_RULINGS_COLLECTION = "mtg_card_rulings" # card oracle texts and rulings, keyed by card uuid (see scripts/build_card_index.py)
+INDEX_WORKERS = 4 # embedding batches sent to the API at the same time while building the index.
+INDEX_MAX_RETRIES = 6 # retries of a rate limited or failed embedding batch (exponential backoff with jitter) before the build stops.
+BUILD_CHECKPOINT_FILE = os.path.join(CHROMA_DB_DIR, "build_checkpoint.json") # finished batches of an in-progress build, to resume it if interrupted
 INDEX_BATCH_SIZE = 100 # how many chunks to embed in each batch. lower means less RAM (API tokens) usage but more time. higher means more RAM (API tokens) usage but less time.
 CHUNK_SIZE = 500 # approximate max number of words per chunk. Smaller chunks means more chunks to embed (bigger DB size), but more precise matching. Larger chunks means less chunks to embed (smaller DB size), but less precise matching.
+CHUNK_CHILD_WORDS = 40 # max words of each child rule embedded in a parent chunk (its first sentence). The full rules are returned on a hit.
 CHUNK_OVERLAP = 100  # The number of words carried over from the end of one chunk into the next (to prevent cutting important context).
 MAX_CONTENT_CHUNKS = 25 # total content chunks to use for final answer
+CONTEXT_MMR_LAMBDA = 0.7 # relevance vs diversity when picking context chunks. 1 means only relevance, lower values skip more near-duplicate chunks.
+RETRIEVAL_BACKEND = "chroma" # "chroma" queries the Chroma collection. "numpy" queries the memory-mapped export of it (see scripts/export_vectors.py).
+VECTOR_EXPORT_DIR = os.path.join(os.getcwd(), "vector_export") # exported matrices for the "numpy" retrieval backend
+HYBRID_SEARCH = True # fuse vector hits with a local BM25 keyword index and resolve explicit rule numbers ("rule 704.5a") directly.
+LEXICAL_INDEX_FILE = os.path.join(CHROMA_DB_DIR, "lexical_index.json") # chunks of the BM25 index, written by build_index
+BM25_K1 = 1.5 # BM25 term frequency saturation.
+BM25_B = 0.75 # BM25 document length normalization.
+RRF_K = 60 # reciprocal-rank fusion constant. Higher values give lower ranks more weight.
+VECTOR_EXPORT_DTYPE = "float32" # "float32", "float16" or "int8". Smaller types use less RAM/disk with a small recall loss.
+EMBED_CACHE_FILE = os.path.join(os.getcwd(), "embedding_cache", "embeddings.sqlite3") # on-disk store of every embedding already paid for (float32 vectors)
+EMBED_CACHE_MAX_ITEMS = 2000 # embeddings kept in the in-memory LRU in front of the disk store. Each one is ~12KB for text-embedding-3-large.
 
 # QUESTION MODEL VARIABLES
 CHAT_MODEL = "gpt-4o-mini"
@@ -27,4 +49,50 @@ MAX_SUBQUERIES = 10 # amount of subqueries to break down the initial query. From
 TOP_K = 8 # X most relevant rule chunks that are semantically closest to my query.
 MODEL_HIGH_TEMPERATURE = 0.3 # for the subqueries steps and judge ruling validation reasoning.
 MODEL_LOW_TEMPERATURE = 0 # for judge and context analysis. Initial and final answer.
+JUDGE_CONTEXT_TOKEN_BUDGET = 8000 # max tokens of rules context + card data sent to the judges.
+REFINEMENT_CONTEXT_TOKEN_BUDGET = 4000 # max tokens of new rules context sent after a denial (the first context is already in the conversation).
+CARD_RULINGS_PER_CARD = 5 # rulings of each selected card sent to the judges, the ones closest to the subqueries.
+CARDS_TOKEN_SHARE = 0.5 # share of the judge budget card data can take before its rulings get trimmed.
 
+# ASK MODE VARIABLES
+DEFAULT_ASK_MODE = "thorough" # mode of /ask requests without "mode" or "latency_budget_ms". "auto" lets the question classifier pick it.
+ASK_MODES = { # per mode retrieval/judging settings. "thorough" is the full pipeline with the settings above.
+    "fast": {"top_k": 4, "max_subqueries": 3, "select_subqueries": False, "second_judge": False, "max_content_chunks": 10, "context_token_budget": 3000}, # ~1 subqueries call + judge 1
+    "balanced": {"top_k": 6, "max_subqueries": 5, "select_subqueries": False, "second_judge": True, "max_content_chunks": 15, "context_token_budget": 5000},
+    "thorough": {"top_k": TOP_K, "max_subqueries": MAX_SUBQUERIES, "select_subqueries": True, "second_judge": True, "max_content_chunks": MAX_CONTENT_CHUNKS, "context_token_budget": JUDGE_CONTEXT_TOKEN_BUDGET},
+}
+MODE_LATENCY_BUDGETS_MS = {"fast": 6000, "balanced": 12000} # a latency_budget_ms below a value picks that mode (the fastest first), otherwise "thorough".
+
+CONCURRENT_PIPELINE = False # True: /ask runs the asyncio pipeline (concurrent retrieval, prefetch during the second judge). Same answers format.
+
+# ANSWER CACHE VARIABLES
+ANSWER_CACHE_TTL_SECONDS = 60 * 60 * 24 # how long a final /ask answer is reused for the same question, cards and settings.
+ANSWER_CACHE_MAX_ITEMS = 1000 # max answers kept in memory. Least recently used ones are evicted first.
+
+
+# JOB QUEUE VARIABLES
+ASK_ASYNC_JOBS = False # True: POST /ask always answers with a job id to poll at GET /ask/<id>. Otherwise only with POST /ask?async=1.
+JOB_WORKERS = 4 # questions answered at the same time in async job mode.
+JOB_MAX_QUEUE_DEPTH = 100 # queued jobs before new ones get a 429.
+JOB_MAX_PER_CLIENT = 5 # queued or running jobs per client before its new ones get a 429.
+JOB_RESULT_TTL_SECONDS = 60 * 10 # how long a finished job can still be fetched.
+JOB_MAX_WAIT_SECONDS = 30 # max long-poll time of GET /ask/<id>?wait=.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0)) # reverse proxies in front of the app. Their X-Forwarded-For gives the client address the job limits and fairness use.
+JOB_STORE_FILE = os.path.join(os.getcwd(), "job_store", "jobs.sqlite3") # status and results of the jobs, shared by the worker processes so any of them answers GET /ask/<id>
+JOB_POLL_SECONDS = 0.25 # how often a long-poll checks the store for a job run by another worker process.
+
+
+# OPENAI CALL VARIABLES
+CHAT_REQUESTS_PER_MINUTE = 500 # rate limits of this process, shared by all its threads. Set them to your account's limits (0: no limit).
+CHAT_TOKENS_PER_MINUTE = 200000 # estimated prompt + completion tokens
+EMBED_REQUESTS_PER_MINUTE = 3000
+EMBED_TOKENS_PER_MINUTE = 1000000
+RATE_LIMIT_BURST_SECONDS = 10 # requests/tokens that can be sent at once after an idle period, in seconds of the rates above.
+CHAT_COMPLETION_TOKENS_ESTIMATE = 500 # completion tokens reserved per chat call when it has no max_tokens.
+STAGE_DEADLINES_SECONDS = {"judge1": 60, "refinement": 60, "judge2": 30, "embeddings": 20, "index_embeddings": 120} # max seconds of an OpenAI call of a stage, retries and rate limit waits included.
+DEFAULT_STAGE_DEADLINE_SECONDS = 30 # deadline of the stages not in STAGE_DEADLINES_SECONDS (subqueries, ...).
+OPENAI_MAX_RETRIES = 3 # retries of a rate limited, failed or timed out call, within its deadline.
+OPENAI_RETRY_BASE_SECONDS = 0.5 # backoff before the first retry, doubled every retry (full jitter).
+OPENAI_RETRY_MAX_SECONDS = 8 # max backoff between retries (unless the API sends a longer retry-after).
+EMBED_HEDGE_AFTER_SECONDS = 2 # send a second identical embeddings request if the first one takes longer, and use the first answer. None: no hedging.
+EMBED_HEDGE_MAX_TEXTS = 16 # only requests of at most this many texts (the question and its subqueries) are hedged, never the index build batches.
@@ -0,0 +1,151 @@
+# -------- IMPORTS --------
+import json
+from collections import OrderedDict
+
+# -------- CONFIG --------
+from utils.config_utils import CONTEXT_MMR_LAMBDA, CARDS_TOKEN_SHARE
+from utils.lexical_utils import tokenize
+from utils.llm_utils import count_tokens
+
+# card fields the judges need. Legalities, rarity, border, ids, etc. don't change a ruling.
+CARD_CONTEXT_FIELDS = ["name", "manaCost", "types", "subtypes", "power", "toughness", "keywords", "originalText", "rulings"]
+
+# -------- HELPER SIMILARITY --------
+def jaccard(a, b):
+    """Jaccard similarity of two token sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+# -------- HELPER SELECT CONTEXT --------
+def select_context(results, max_chunks, exclude_ids=()):
+    """
+    Pick the retrieved chunks that go into the judge context.
+
+    Hits are deduped by chunk id (one entry per chunk, listing every subquery that found it), scored by
+    how many subqueries found them and how high (rank and distance), and then picked with MMR so that
+    near-duplicate chunks don't take the slots of distinct rules.
+
+    Args:
+        results (list[dict]): Hits from collect_results ({"id", "subquery", "source", "text", "rank", "distance"}).
+        max_chunks (int): How many chunks to keep.
+        exclude_ids (iterable): Chunk ids already in the context (e.g. from the first judge call).
+
+    Returns:
+        list[dict]: The selected chunks, best first, each with a "subqueries" list.
+    """
+    exclude_ids = set(exclude_ids)
+    chunks = OrderedDict()
+    for r in results:
+        if r["id"] in exclude_ids:
+            continue
+
+        chunk = chunks.get(r["id"])
+        if chunk is None:
+            chunk = chunks[r["id"]] = {"id": r["id"], "source": r["source"], "text": r["text"], "subqueries": [], "score": 0.0}
+        if r["subquery"] not in chunk["subqueries"]:
+            chunk["subqueries"].append(r["subquery"])
+
+        # every subquery that finds the chunk adds to its score, more when ranked higher or closer
+        hit_score = 1.0 / (1 + r["rank"])
+        if r.get("distance") is not None:
+            hit_score *= 1.0 / (1 + r["distance"])
+        chunk["score"] += hit_score
+
+    candidates = list(chunks.values())
+    if not candidates:
+        return []
+
+    top_score = max(c["score"] for c in candidates)
+    tokens = {c["id"]: set(tokenize(c["text"])) for c in candidates}
+
+    # MMR: relevance minus similarity to the chunks already selected
+    selected = []
+    while candidates and len(selected) < max_chunks:
+        best = max(
+            candidates,
+            key=lambda c: CONTEXT_MMR_LAMBDA * c["score"] / top_score
+            - (1 - CONTEXT_MMR_LAMBDA) * max((jaccard(tokens[c["id"]], tokens[s["id"]]) for s in selected), default=0.0)
+        )
+        candidates.remove(best)
+        selected.append(best)
+
+    return selected
+
+# -------- HELPER REFERENCE CHUNKS --------
+def reference_chunks(chunks, rules_index):
+    """
+    Chunks of the rules the selected chunks cite as "see rule X" and don't already contain.
+    Put them after the selected chunks in assemble_context, so they only take the budget that is left.
+    """
+    included = "\n".join(c["text"] for c in chunks)
+    refs = {}
+    for chunk in chunks:
+        for rule_id, text in rules_index.expand_references(chunk["text"]).items():
+            if rule_id in refs or text in included:
+                continue
+            refs[rule_id] = {"id": f"ref:{rule_id}", "source": "Comprehensive Rules", "text": text, "subqueries": [f"cited by {chunk['id']}"], "score": 0.0}
+    return list(refs.values())
+
+# -------- HELPER FORMAT CHUNK --------
+def format_chunk(chunk):
+    """Render a selected chunk for the judge prompts."""
+    return f"Subquery: {' | '.join(chunk['subqueries'])}\n- Source: {chunk['source']}\n- Text: {chunk['text']}"
+
+# -------- HELPER COMPACT CARD --------
+def compact_card(card):
+    """Card with only CARD_CONTEXT_FIELDS, without empty values and with rulings reduced to their text."""
+    compact = {k: card[k] for k in CARD_CONTEXT_FIELDS if card.get(k) not in (None, "", [], {})}
+    if "rulings" in compact:
+        compact["rulings"] = [r.get("text", "") if isinstance(r, dict) else r for r in compact["rulings"]]
+    return compact
+
+# -------- HELPER ASSEMBLE CONTEXT --------
+def assemble_context(chunks, cards_info, budget, golden_rules=""):
+    """
+    Build the judge context within a token budget.
+
+    The golden rules always go in. Cards are compacted (see compact_card) and, if they take more than
+    CARDS_TOKEN_SHARE of the budget, their rulings are trimmed starting with the cards that have the most.
+    The rest of the budget is filled with chunks in their selection order.
+
+    Args:
+        chunks (list[dict]): Chunks from select_context, best first.
+        cards_info (list[dict]): Cards selected by the user.
+        budget (int): Max tokens of the context and cards together.
+        golden_rules (str): Text always put first in the context.
+
+    Returns:
+        dict: {"context": rules text, "cards": cards text, "chunks": chunks that fit, "tokens": tokens used}
+    """
+    used = count_tokens(golden_rules) if golden_rules else 0
+
+    # Cards: compact, then trim rulings until they fit in their share of the budget
+    cards = [compact_card(c) for c in cards_info]
+    cards_text = "No specific cards provided."
+    if cards:
+        ruling_tokens = [[count_tokens(r) for r in c.get("rulings", [])] for c in cards]
+        cards_tokens = count_tokens(json.dumps(cards, ensure_ascii=False))
+        while cards_tokens > budget * CARDS_TOKEN_SHARE and any(ruling_tokens):
+            i = max(range(len(cards)), key=lambda i: len(ruling_tokens[i]))
+            cards[i]["rulings"].pop()
+            cards_tokens -= ruling_tokens[i].pop()
+            if not cards[i]["rulings"]:
+                del cards[i]["rulings"]
+        cards_text = json.dumps(cards, ensure_ascii=False)
+    used += count_tokens(cards_text)
+
+    # Chunks: best first, skipping the ones that don't fit anymore
+    blocks, kept = [], []
+    if golden_rules:
+        blocks.append(golden_rules)
+    for chunk in chunks:
+        block = format_chunk(chunk)
+        tokens = count_tokens(block)
+        if used + tokens > budget:
+            continue
+        used += tokens
+        blocks.append(block)
+        kept.append(chunk)
+
+    return {"context": "\n\n".join(blocks), "cards": cards_text, "chunks": kept, "tokens": used}
@@ -0,0 +1,188 @@
+# -------- IMPORTS --------
+import os
+import re
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+# -------- CONFIG --------
+from utils.config_utils import EMBED_MODEL, EMBED_CACHE_FILE, EMBED_CACHE_MAX_ITEMS
+from utils.llm_utils import create_embeddings, acreate_embeddings
+from utils.metrics_utils import metrics
+
+# -------- HELPER NORMALIZE TEXT --------
+def normalize_text(text):
+    """Normalize text for cache keys (case and whitespace insensitive)."""
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+# -------- EMBEDDING CACHE --------
+class EmbeddingCache:
+    """
+    Two level cache of embedding vectors keyed on (model, normalized text).
+
+    A size-bounded in-memory LRU sits in front of a local SQLite store that keeps
+    every vector as float32 bytes, so repeated texts never hit the embeddings API again,
+    not even after a restart.
+    """
+
+    def __init__(self, path, max_items, model):
+        self.model = model
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> array("f"), most recently used last
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = self._connect()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL") # lets the server and build scripts share the file
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                key TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, key)
+            )
+        """)
+        db.commit()
+        return db
+
+    def _conn(self):
+        """The SQLite connection of this process. A forked worker opens its own (the parent's can't be shared). Caller must hold the lock."""
+        if self._pid != os.getpid():
+            self._db, self._pid = self._connect(), os.getpid()
+        return self._db
+
+    @staticmethod
+    def key(text):
+        """Cache key of a text: sha1 of its normalized form."""
+        return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vec):
+        """Insert into the in-memory LRU, evicting the least recently used entries."""
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return a dict key -> vector (list[float]) for every key found in memory or on disk."""
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vec
+                    self.memory_hits += 1
+                else:
+                    missing.append(key)
+
+            if missing:
+                placeholders = ",".join("?" * len(missing))
+                rows = self._conn().execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [self.model, *missing]
+                ).fetchall()
+                for key, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    self._remember(key, vec)
+                    found[key] = vec
+                self.disk_hits += len(rows)
+                self.misses += len(missing) - len(rows)
+
+        return {key: vec.tolist() for key, vec in found.items()}
+
+    def put_many(self, items):
+        """Store (key, vector) pairs in memory and on disk."""
+        with self._lock:
+            rows = []
+            for key, vec in items:
+                vec = array("f", vec)
+                self._remember(key, vec)
+                rows.append((self.model, key, vec.tobytes()))
+            db = self._conn()
+            db.executemany("INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)", rows)
+            db.commit()
+
+    def stats(self):
+        """Hit/miss counters and hit rate since startup."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_items": len(self._memory)
+        }
+
+# Open the cache once (outside function, at server startup)
+embedding_cache = EmbeddingCache(EMBED_CACHE_FILE, EMBED_CACHE_MAX_ITEMS, EMBED_MODEL)
+
+# Embeddings API usage since startup (only cache misses reach the API)
+embedding_usage = {"requests": 0, "tokens": 0}
+usage_lock = threading.Lock()
+
+# -------- HELPER EMBED TEXTS --------
+def embed_texts(texts, stage="embeddings"):
+    """
+    Embed texts with EMBED_MODEL, going to the API only for texts that are not cached yet.
+    All cache misses are sent in a single embeddings request.
+
+    Args:
+        texts (list[str]): The texts to embed.
+        stage (str): Stage of the call, for its deadline and metrics ("index_embeddings" for index builds).
+
+    Returns:
+        list[list[float]]: One vector per text, in the same order.
+    """
+    keys, vectors, missing = cached_embeddings(texts)
+    if missing:
+        store_embeddings(create_embeddings(list(missing.values()), stage), missing, vectors)
+    return [vectors[key] for key in keys]
+
+# -------- HELPER ASYNC EMBED TEXTS --------
+async def aembed_texts(texts):
+    """Same as embed_texts, with the async client. The cache (SQLite and its lock) is used from a thread, off the event loop."""
+    keys, vectors, missing = await asyncio.to_thread(cached_embeddings, texts)
+    if missing:
+        emb = await acreate_embeddings(list(missing.values()))
+        await asyncio.to_thread(store_embeddings, emb, missing, vectors)
+    return [vectors[key] for key in keys]
+
+# -------- HELPER CACHED EMBEDDINGS --------
+def cached_embeddings(texts):
+    """Cache lookup of texts. Returns (keys, {key: vector} of the cached ones, {key: text} to embed, each text once)."""
+    keys = [EmbeddingCache.key(t) for t in texts]
+    vectors = embedding_cache.get_many(set(keys))
+
+    # embed each missing text only once, even if it is repeated in texts
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    return keys, vectors, missing
+
+# -------- HELPER STORE EMBEDDINGS --------
+def store_embeddings(emb, missing, vectors):
+    """Record the usage of an embeddings response for the missing texts, cache its vectors and add them to vectors."""
+    tokens = emb.usage.total_tokens if getattr(emb, "usage", None) else 0
+    with usage_lock:
+        embedding_usage["requests"] += 1
+        embedding_usage["tokens"] += tokens
+    metrics.inc("mtg_embedding_tokens_total", tokens)
+    new_vecs = [d.embedding for d in sorted(emb.data, key=lambda d: d.index)]
+    new_items = list(zip(missing.keys(), new_vecs))
+    embedding_cache.put_many(new_items)
+    vectors.update(new_items)
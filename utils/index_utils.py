@@ -2,39 +2,184 @@
 import os
 import re
 import json
+import time
+import random
+import hashlib
 import chromadb
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # -------- CONFIG --------
-from utils.config_utils import CHUNK_SIZE, CHROMA_DB_DIR, RULES_FILE, EMBED_MODEL, CLIENT, CHUNK_OVERLAP, INDEX_BATCH_SIZE
+from utils.config_utils import CHUNK_SIZE, CHUNK_CHILD_WORDS, CHROMA_DB_DIR, RULES_FILE, CHUNK_OVERLAP, INDEX_BATCH_SIZE, EMBED_MODEL, COLLECTION_NAME, ACTIVE_COLLECTION_FILE, BUILD_CHECKPOINT_FILE, INDEX_WORKERS, INDEX_MAX_RETRIES, RETRIEVAL_BACKEND, VECTOR_EXPORT_DTYPE, LEXICAL_INDEX_FILE, CARD_RULINGS_COLLECTION
+from utils.embedding_utils import embed_texts, embedding_cache, embedding_usage
+from utils.vector_utils import export_vectors
+from utils.lexical_utils import BM25Index
+from utils.throttle_utils import RETRYABLE_ERRORS, DeadlineExceededError, retry_after_seconds
+
+# rules collections use cosine distances (1 - cosine similarity), the same as the "numpy" retrieval backend
+RULES_COLLECTION_METADATA = {"hnsw:space": "cosine"}
 
 # -------- INITIALIZATION --------
 os.makedirs(CHROMA_DB_DIR, exist_ok=True) # to create folder if it doesn't exist
-client = CLIENT
+
+# -------- HELPER SPLIT RULES TEXT --------
+def split_rules_text(text):
+    """
+    Split the comprehensive rules into the numbered rules and the glossary.
+    The "Glossary" and "Credits" headings appear twice (table of contents and body), the body ones are the last.
+
+    Returns:
+        tuple[str, str]: (rules text, glossary text). The glossary is empty if there is no glossary heading.
+    """
+    text = text.replace("\r\n", "\n")
+    headings = list(re.finditer(r"^Glossary[ \t]*$", text, re.M))
+    if not headings:
+        return text, ""
+
+    glossary_start = headings[-1]
+    credits = [m for m in re.finditer(r"^Credits[ \t]*$", text, re.M) if m.start() > glossary_start.end()]
+    glossary_end = credits[0].start() if credits else len(text)
+    return text[:glossary_start.start()], text[glossary_start.end():glossary_end]
 
 # -------- HELPER LOAD RULES --------
 def load_rules(path):
-    """Load the MTG comprehensive rules from a text file into rule entries."""
+    """Load the MTG comprehensive rules from a text file into rule entries (without the glossary)."""
     if not os.path.exists(path):
         print(f"Rules file not found at {path}")
         return []
 
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        text = f.read()
+        text, _ = split_rules_text(f.read()) # otherwise the glossary ends up in the text of the last rule
 
-    # Matches "603.1a Rule text possibly spanning multiple lines"
-    pattern = re.compile(r"^(\d{1,3}(?:\.\d+)*[a-z]?)\s+(.*?)(?=\n\d{1,3}(?:\.\d+)*[a-z]?\s|\Z)", re.S | re.M)
+    # Matches "603.1a Rule text possibly spanning multiple lines", "603.1. Rule text" and "603. Section title"
+    pattern = re.compile(r"^(\d{1,3}(?:\.\d+)*[a-z]?)\.?\s+(.*?)(?=\n\d{1,3}(?:\.\d+)*[a-z]?\.?\s|\Z)", re.S | re.M)
     
-    docs = []
+    docs = {}
     for match in pattern.finditer(text):
         rule_id, body = match.groups()
-        body = body.strip().replace("\n", " ")
-        docs.append({
+        body = re.sub(r"\s+", " ", body.strip()) # also drops the \r of CRLF files
+        # the table of contents lists every section first, keep the later occurrence from the rules body
+        docs.pop(rule_id, None)
+        docs[rule_id] = {
             "id": f"CR:{rule_id}",
             "text": f"{rule_id} {body}",
             "rule_id": rule_id,
             "source": "Comprehensive Rules"
-        })
-    return docs
+        }
+    return list(docs.values())
+
+# -------- HELPER LOAD GLOSSARY --------
+def load_glossary(path):
+    """Load the glossary of the comprehensive rules: one entry per term ("Trample" -> its definition)."""
+    if not os.path.exists(path):
+        return []
+
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        _, text = split_rules_text(f.read())
+
+    entries = {}
+    for block in re.split(r"\n\s*\n", text):
+        lines = [line.strip() for line in block.strip().splitlines() if line.strip()]
+        if len(lines) < 2:
+            continue
+        term, definition = lines[0], " ".join(lines[1:])
+        entries[term] = {
+            "id": f"GL:{term}",
+            "text": f"{term}: {definition}",
+            "term": term,
+            "source": "Comprehensive Rules Glossary"
+        }
+    return list(entries.values())
+
+# -------- HELPER COMPACT RULE TEXT --------
+def compact_rule_text(text):
+    """First sentence of a rule, at most CHUNK_CHILD_WORDS words: what a parent chunk embeds for each child rule."""
+    first = re.split(r"(?<=[.!?]) +(?=[A-Z(])", text, maxsplit=1)[0]
+    words = first.split()
+    if len(words) > CHUNK_CHILD_WORDS:
+        return " ".join(words[:CHUNK_CHILD_WORDS]) + " ..."
+    return first
+
+# -------- HELPER RULE PARENTS --------
+def rule_parents(rules):
+    """
+    Group the rules following the CR hierarchy: section ("702. Keyword Abilities") -> rule ("702.19") -> subrules ("702.19a").
+
+    Every rule and its subrules stay together, and consecutive small rules of the same section are packed into one parent
+    of up to CHUNK_SIZE words. A rule longer than that (e.g. 704.5 with its subrules) is split at subrule boundaries.
+
+    Returns:
+        list[dict]: Parents with "section" (heading text) and "children" (rule ids, in rules order).
+    """
+    texts = {r["rule_id"]: r["text"] for r in rules}
+    words = {rule_id: len(text.split()) for rule_id, text in texts.items()}
+
+    # headings: "1. Game Concepts" and "702. Keyword Abilities" have no dot in their id
+    headings = {rule_id: text for rule_id, text in texts.items() if "." not in rule_id}
+
+    # section -> [(rule, [rule and its subrules])], in rules order
+    sections = {}
+    for rule_id in texts:
+        if "." not in rule_id:
+            continue
+        section = rule_id.split(".")[0]
+        groups = sections.setdefault(section, [])
+        lead = rule_id[:-1] if rule_id[-1].isalpha() else rule_id
+        if groups and groups[-1][0] == lead:
+            groups[-1][1].append(rule_id)
+        else:
+            groups.append((lead, [rule_id]))
+
+    parents = []
+    for section, groups in sections.items():
+        heading = headings.get(section, section)
+        current, size = [], 0
+
+        def close():
+            if current:
+                parents.append({"section": heading, "children": list(current)})
+
+        for lead, members in groups:
+            group_size = sum(words[m] for m in members)
+            if current and size + group_size > CHUNK_SIZE:
+                close()
+                current, size = [], 0
+
+            if group_size <= CHUNK_SIZE:
+                current.extend(members)
+                size += group_size
+                continue
+
+            # a single rule too long for one parent: split it at subrule boundaries
+            for member in members:
+                if current and size + words[member] > CHUNK_SIZE:
+                    close()
+                    current, size = [], 0
+                current.append(member)
+                size += words[member]
+
+        close()
+
+    return parents
+
+# -------- HELPER EXPAND CHUNK TEXT --------
+def expand_chunk_text(text, meta, rule_texts):
+    """
+    Full text of a retrieved chunk: a rules parent is embedded in compact form, so on a hit its children are
+    resolved by id (rule_texts: rule id -> text, e.g. RulesIndex.texts). Other chunks are returned as they are.
+    """
+    children = (meta or {}).get("children")
+    if not children:
+        return text
+    parts = [rule_texts.get(child) for child in children.split(",")]
+    if not all(parts):
+        return text # rules file changed since the index was built
+    return "\n".join(parts)
+
+# -------- HELPER BUILD LEXICAL INDEX --------
+def build_lexical_index(ids, texts, metas):
+    """BM25 index of the chunks, over their full text (children of the rules parents included)."""
+    rule_texts = {r["rule_id"]: r["text"] for r in load_rules(RULES_FILE)}
+    return BM25Index(ids, [expand_chunk_text(t, m, rule_texts) for t, m in zip(texts, metas)], metas)
 
 # -------- HELPER CHUNK TEXT --------
 def chunk_text(text):
@@ -80,67 +225,323 @@ def chunk_text(text):
 
     return chunks
 
-# -------- HELPER BUILD INDEX --------
-def build_index():
-    """Create ChromaDB collection from rules with batching and optimized metadata."""
+# -------- HELPER CONTENT HASH --------
+def content_hash(text):
+    """Hash of a chunk as embedded. Includes EMBED_MODEL so changing the model re-embeds everything."""
+    return hashlib.sha1(f"{EMBED_MODEL}\n{text}".encode("utf-8")).hexdigest()
+
+# -------- HELPER RULING TEXT --------
+def ruling_text(ruling):
+    """Text of a card ruling ({"date", "text"} in the cards file), as indexed in the card rulings collection."""
+    return ruling.get("text", "") if isinstance(ruling, dict) else str(ruling)
+
+# -------- HELPER ACTIVE COLLECTION --------
+def get_active_collection_name():
+    """Name of the Chroma collection the server should query (written by build_index after a successful build)."""
+    try:
+        with open(ACTIVE_COLLECTION_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip() or COLLECTION_NAME
+    except OSError:
+        return COLLECTION_NAME # index built before incremental builds existed
+
+def set_active_collection_name(name):
+    """Atomically point the server to another collection."""
+    tmp_path = f"{ACTIVE_COLLECTION_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp_path, ACTIVE_COLLECTION_FILE)
+
+# -------- HELPER PREPARE CHUNKS --------
+def prepare_chunks():
+    """
+    Load and chunk the rules and the glossary. Returns (ids, texts, metas) with a content hash in every meta.
+
+    Rules are chunked by rule_parents: each parent embeds the section heading and a compact first sentence of each child
+    rule, and lists its children ("702.19,702.19a,...") in its meta so the full rules are returned on a hit (expand_chunk_text).
+    Glossary entries are chunks of their own (kind "glossary").
+    """
     print("Loading rules...")
     
     rules = load_rules(RULES_FILE)
-    print(f"Loaded {len(rules)} rules")
-
-    all_docs = rules  # cards now handled separately
+    glossary = load_glossary(RULES_FILE)
+    print(f"Loaded {len(rules)} rules and {len(glossary)} glossary entries")
 
+    rule_texts = {r["rule_id"]: r["text"] for r in rules}
     texts, metas, ids = [], [], []
 
     print("Chunking rules...")
-    for d in all_docs:
-        chunks = chunk_text(d["text"])
-        for i, ch in enumerate(chunks):
+    for parent in rule_parents(rules):
+        children = parent["children"]
+        text = "\n".join([parent["section"]] + [compact_rule_text(rule_texts[c]) for c in children])
+        texts.append(text)
+        metas.append({
+            "id": f"CR:{children[0]}",
+            "rule_id": children[0],
+            "children": ",".join(children),
+            "kind": "rules",
+            "source": "Comprehensive Rules",
+            "content_hash": content_hash(text)
+        })
+        ids.append(f"CR:{children[0]}")
+
+    for d in glossary:
+        for i, ch in enumerate(chunk_text(d["text"])):
             texts.append(ch)
             metas.append({
                 "id": d["id"],
-                "rule_id": d.get("rule_id", None),
-                "source": d.get("source", "Comprehensive Rules")
+                "term": d["term"],
+                "kind": "glossary",
+                "source": d["source"],
+                "content_hash": content_hash(ch)
             })
             ids.append(f"{d['id']}_{i}")
 
     if not texts:
         raise ValueError("No valid chunks found to embed.")
 
-    print(f"Total chunks: {len(texts)}")
+    embedded_words = sum(len(t.split()) for t in texts)
+    full_words = sum(len(t.split()) for t in rule_texts.values()) + sum(len(d["text"].split()) for d in glossary)
+    print(f"Total chunks: {len(texts)} ({embedded_words} words embedded for {full_words} words of rules and glossary)")
+    return ids, texts, metas
+
+# -------- HELPER CHECKPOINT --------
+def load_checkpoint(plan_hash):
+    """Return the checkpoint of an interrupted build of the same plan, or None."""
+    try:
+        with open(BUILD_CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    return checkpoint if checkpoint.get("plan_hash") == plan_hash else None
+
+def save_checkpoint(checkpoint):
+    """Atomically write the build checkpoint."""
+    tmp_path = f"{BUILD_CHECKPOINT_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, BUILD_CHECKPOINT_FILE)
+
+# -------- HELPER EMBED WITH BACKOFF --------
+def embed_with_backoff(batch_texts):
+    """Embed a batch, retrying rate limits and transient API errors with jittered exponential backoff."""
+    for attempt in range(INDEX_MAX_RETRIES + 1):
+        try:
+            return embed_texts(batch_texts, stage="index_embeddings") # own deadline, and big batches are never hedged
+        except RETRYABLE_ERRORS + (DeadlineExceededError,) as e:
+            # the calls already retry quickly within their deadline, these are longer waits for a long build
+            if attempt == INDEX_MAX_RETRIES:
+                raise
+
+            # honor the server's retry-after when it sends one
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = min(2 ** attempt, 60) * (0.5 + random.random())
+            print(f"Embedding batch failed ({type(e).__name__}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+# -------- HELPER EMBED IN POOL --------
+def embed_in_pool(pending_batches, texts, write_batch):
+    """
+    Embed batches on a pool of INDEX_WORKERS threads (at most 2 batches per worker in flight).
+    The calling thread is the only writer: write_batch(batch_id, batch, vecs) is called as batches finish.
+
+    Args:
+        pending_batches (list[tuple[str, list[int]]]): (batch id, indexes into texts) to embed.
+        texts (list[str]): All texts.
+        write_batch (callable): Stores a finished batch.
+    """
+    total_chunks = sum(len(batch) for _, batch in pending_batches)
+
+    print(f"Creating embeddings in {len(pending_batches)} batches with {INDEX_WORKERS} workers...")
+    started = time.monotonic()
+    tokens_before = embedding_usage["tokens"]
+    indexed = 0
+
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+        queue = iter(pending_batches)
+        in_flight = {}
+
+        def submit_next():
+            for batch_id, batch in queue:
+                in_flight[pool.submit(embed_with_backoff, [texts[j] for j in batch])] = (batch_id, batch)
+                return
+
+        for _ in range(INDEX_WORKERS * 2):
+            submit_next()
+
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch_id, batch = in_flight.pop(future)
+                write_batch(batch_id, batch, future.result()) # a batch that failed all retries stops the build, the checkpoint keeps the rest
+                submit_next()
+
+                indexed += len(batch)
+                elapsed = max(time.monotonic() - started, 1e-9)
+                tokens = embedding_usage["tokens"] - tokens_before
+                print(f"Indexed {indexed}/{total_chunks} chunks ({indexed / elapsed:.1f} chunks/sec, {tokens / elapsed:.0f} tokens/sec)")
+
+# -------- HELPER BUILD INDEX --------
+def build_index():
+    """
+    Incrementally build the ChromaDB collection from the rules.
+
+    Chunks are diffed against the live collection by content hash. Unchanged chunks are copied
+    with their stored vectors, only new or changed ones are embedded, and removed ones are left out.
+    The result is built into a new shadow collection and swapped in atomically at the end, so the
+    server never queries a half-built index.
+
+    Embedding batches run on a pool of INDEX_WORKERS threads while this thread is the only Chroma writer.
+    Finished batches are checkpointed, so an interrupted build resumes where it stopped.
+    """
+    ids, texts, metas = prepare_chunks()
 
     # Initialize Chroma client
     chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+    existing = {c.name if hasattr(c, "name") else c for c in chroma_client.list_collections()}
 
-    # Drop old collection (safe)
-    try:
-        chroma_client.delete_collection("mtg_data")
-        print("Old collection deleted.")
-    except Exception:
-        print("No old collection to delete.")
-
-    collection = chroma_client.get_or_create_collection(name="mtg_data")
-
-    # Batch embeddings
-    print("Creating embeddings in batches...")
-    for i in range(0, len(texts), INDEX_BATCH_SIZE):
-        batch_texts = texts[i:i + INDEX_BATCH_SIZE]
-        batch_ids = ids[i:i + INDEX_BATCH_SIZE]
-        batch_metas = metas[i:i + INDEX_BATCH_SIZE]
-
-        embeddings = client.embeddings.create(
-            model=EMBED_MODEL,
-            input=batch_texts
-        )
-        vecs = [d.embedding for d in embeddings.data]
+    # Content hashes of the live collection
+    live_name = get_active_collection_name()
+    live_hashes = {}
+    live = None
+    if live_name in existing:
+        live = chroma_client.get_collection(live_name)
+        current = live.get(include=["metadatas", "documents"])
+        for chunk_id, meta, doc in zip(current["ids"], current["metadatas"], current["documents"]):
+            live_hashes[chunk_id] = (meta or {}).get("content_hash") or content_hash(doc)
+
+    unchanged = [i for i, chunk_id in enumerate(ids) if live_hashes.get(chunk_id) == metas[i]["content_hash"]]
+    changed = [i for i, chunk_id in enumerate(ids) if live_hashes.get(chunk_id) != metas[i]["content_hash"]]
+    removed = set(live_hashes) - set(ids)
+    print(f"Unchanged chunks: {len(unchanged)}, new or changed: {len(changed)}, removed: {len(removed)}")
+
+    if live is not None and not changed and not removed:
+        build_lexical_index(ids, texts, metas).save(LEXICAL_INDEX_FILE)
+        print("Index is already up to date!")
+        return
 
-        collection.add(
-            ids=batch_ids,
+    # Resume an interrupted build of the same plan (same live collection and same chunks)
+    plan_hash = hashlib.sha1(json.dumps([live_name, ids, [m["content_hash"] for m in metas], INDEX_BATCH_SIZE]).encode("utf-8")).hexdigest()
+    checkpoint = load_checkpoint(plan_hash)
+    if checkpoint is not None and checkpoint["shadow"] in existing:
+        print(f"Resuming build of {checkpoint['shadow']} ({len(checkpoint['done'])} batches already done)")
+    else:
+        checkpoint = {"plan_hash": plan_hash, "shadow": f"{COLLECTION_NAME}_{time.strftime('%Y%m%d%H%M%S')}", "done": []}
+        save_checkpoint(checkpoint)
+
+    shadow_name = checkpoint["shadow"]
+    done = set(checkpoint["done"])
+    collection = chroma_client.get_or_create_collection(name=shadow_name, metadata=RULES_COLLECTION_METADATA)
+    print(f"Building shadow collection {shadow_name}...")
+
+    def write_batch(batch_id, batch, vecs):
+        """Single writer: add a finished batch to the shadow collection and checkpoint it."""
+        collection.upsert(
+            ids=[ids[j] for j in batch],
             embeddings=vecs,
-            documents=batch_texts,
-            metadatas=batch_metas
+            documents=[texts[j] for j in batch],
+            metadatas=[metas[j] for j in batch]
         )
+        done.add(batch_id)
+        checkpoint["done"] = sorted(done)
+        save_checkpoint(checkpoint)
+
+    # Copy unchanged chunks with their stored vectors (no API calls)
+    for i in range(0, len(unchanged), INDEX_BATCH_SIZE):
+        batch_id = f"copy-{i}"
+        if batch_id in done:
+            continue
+
+        batch = unchanged[i:i + INDEX_BATCH_SIZE]
+        stored = live.get(ids=[ids[j] for j in batch], include=["embeddings"])
+        vecs_by_id = dict(zip(stored["ids"], stored["embeddings"]))
+        write_batch(batch_id, batch, [vecs_by_id[ids[j]] for j in batch])
+
+        print(f"Copied {i + len(batch)}/{len(unchanged)} unchanged chunks")
+
+    # Embed new and changed chunks on the worker pool
+    pending_batches = [(f"embed-{i}", changed[i:i + INDEX_BATCH_SIZE]) for i in range(0, len(changed), INDEX_BATCH_SIZE)]
+    pending_batches = [(batch_id, batch) for batch_id, batch in pending_batches if batch_id not in done]
+    embed_in_pool(pending_batches, texts, write_batch)
+
+    # Swap: the server picks up the new collection (and the BM25 index of the same chunks) on its next query
+    build_lexical_index(ids, texts, metas).save(LEXICAL_INDEX_FILE)
+    set_active_collection_name(shadow_name)
+    os.remove(BUILD_CHECKPOINT_FILE)
+    print(f"Active collection is now {shadow_name}")
 
-        print(f"Indexed {i + len(batch_texts)}/{len(texts)} chunks")
+    # Drop older collections, but keep the previous one for requests still running against it
+    for name in existing:
+        if name.startswith(COLLECTION_NAME) and name not in (shadow_name, live_name):
+            chroma_client.delete_collection(name)
+            print(f"Old collection {name} deleted.")
 
+    # Keep the memory-mapped export of the numpy backend in sync
+    if RETRIEVAL_BACKEND == "numpy":
+        export_vectors(collection, VECTOR_EXPORT_DTYPE)
+
+    print(f"Embedding cache: {embedding_cache.stats()}")
     print("Index built and saved with ChromaDB!")
+
+# -------- HELPER CARD DOCS --------
+def card_docs(cards):
+    """Oracle text and rulings of every card as (ids, texts, metas), keyed by card uuid."""
+    ids, texts, metas = [], [], []
+    for card in cards:
+        uuid, name = card.get("uuid"), card.get("name", "")
+        if not uuid:
+            continue
+
+        if card.get("originalText"):
+            text = f"{name}: {card['originalText']}"
+            ids.append(f"{uuid}:oracle")
+            texts.append(text)
+            metas.append({"uuid": uuid, "name": name, "kind": "oracle", "content_hash": content_hash(text)})
+
+        for i, ruling in enumerate(card.get("rulings") or []):
+            text = ruling_text(ruling)
+            if not text:
+                continue
+            ids.append(f"{uuid}:ruling:{i}")
+            texts.append(text)
+            metas.append({"uuid": uuid, "name": name, "kind": "ruling", "date": ruling.get("date", "") if isinstance(ruling, dict) else "", "content_hash": content_hash(text)})
+
+    return ids, texts, metas
+
+# -------- HELPER BUILD CARD INDEX --------
+def build_card_index(cards):
+    """
+    Index card oracle texts and rulings in their own collection (CARD_RULINGS_COLLECTION), keyed by card uuid,
+    so only the rulings relevant to a question are sent to the judges.
+    Incremental like build_index: only new or changed texts are embedded and removed ones are deleted.
+    """
+    ids, texts, metas = card_docs(cards)
+    print(f"Total card texts and rulings: {len(texts)}")
+
+    chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+    collection = chroma_client.get_or_create_collection(name=CARD_RULINGS_COLLECTION)
+
+    current = collection.get(include=["metadatas"])
+    live_hashes = {chunk_id: (meta or {}).get("content_hash") for chunk_id, meta in zip(current["ids"], current["metadatas"])}
+
+    changed = [i for i, doc_id in enumerate(ids) if live_hashes.get(doc_id) != metas[i]["content_hash"]]
+    removed = list(set(live_hashes) - set(ids))
+    print(f"Unchanged: {len(ids) - len(changed)}, new or changed: {len(changed)}, removed: {len(removed)}")
+
+    for i in range(0, len(removed), INDEX_BATCH_SIZE):
+        collection.delete(ids=removed[i:i + INDEX_BATCH_SIZE])
+
+    def write_batch(batch_id, batch, vecs):
+        collection.upsert(
+            ids=[ids[j] for j in batch],
+            embeddings=vecs,
+            documents=[texts[j] for j in batch],
+            metadatas=[metas[j] for j in batch]
+        )
+
+    # every upserted batch is final, so an interrupted build just resumes with the remaining diff
+    embed_in_pool([(f"embed-{i}", changed[i:i + INDEX_BATCH_SIZE]) for i in range(0, len(changed), INDEX_BATCH_SIZE)], texts, write_batch)
+
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    print("Card index built and saved with ChromaDB!")
@@ -0,0 +1,322 @@
+# -------- IMPORTS --------
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+
+# -------- CONFIG --------
+from utils.config_utils import JOB_WORKERS, JOB_MAX_QUEUE_DEPTH, JOB_MAX_PER_CLIENT, JOB_RESULT_TTL_SECONDS, JOB_STORE_FILE, JOB_POLL_SECONDS
+
+class QueueFullError(Exception):
+    """The job queue, or the share of one client, is full."""
+
+# -------- JOB --------
+class Job:
+    """One queued question: status goes from "queued" to "running" to "done" or "error"."""
+
+    def __init__(self, client_id, compute, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.client_id = client_id
+        self.compute = compute
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+        self.created_at = time.time() # wall clock, compared across processes in the job store
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self, position=None):
+        """JSON view of the job for GET /ask/<id>."""
+        data = {"job_id": self.id, "status": self.status}
+        if position is not None:
+            data["position"] = position
+        if self.status == "done":
+            data["result"] = self.result
+        elif self.status == "error":
+            data["error"] = self.error
+        return data
+
+# -------- JOB STORE --------
+class JobStore:
+    """
+    Status and results of the jobs in a local SQLite file shared by every worker process.
+
+    A job runs in the process that queued it, but GET /ask/<id> can reach any worker: the ones that don't
+    have it in memory read it from here. Also counts the unfinished jobs of a client across the processes.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = self._connect()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL") # readers in the other workers don't block the writer
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                client_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                finished REAL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client_id, status)")
+        db.commit()
+        return db
+
+    def _conn(self):
+        """The SQLite connection of this process. A forked worker opens its own (the parent's can't be shared). Caller must hold the lock."""
+        if self._pid != os.getpid():
+            self._db, self._pid = self._connect(), os.getpid()
+        return self._db
+
+    def save(self, job):
+        """Write the current status (and result or error) of a job."""
+        result = json.dumps(job.result) if job.status == "done" else None
+        with self._lock:
+            db = self._conn()
+            db.execute(
+                "INSERT OR REPLACE INTO jobs (id, client_id, status, result, error, created, finished) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.client_id, job.status, result, job.error, job.created_at, time.time() if job.finished is not None else None)
+            )
+            db.commit()
+
+    def load(self, job_id):
+        """Return the job as a Job (without compute), or None if it doesn't exist or expired."""
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT id, client_id, status, result, error, created, finished FROM jobs WHERE id = ? AND (finished IS NULL OR finished > ?)",
+                (job_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        if row is None:
+            return None
+
+        job = Job(row[1], None, job_id=row[0])
+        job.status, job.error, job.created_at = row[2], row[4], row[5]
+        job.result = json.loads(row[3]) if row[3] is not None else None
+        if row[6] is not None:
+            job.finished = time.monotonic()
+            job.done.set()
+        return job
+
+    def active(self, client_id):
+        """Queued or running jobs of a client in every worker process (unfinished ones older than the ttl are ignored, their worker died)."""
+        with self._lock:
+            return self._conn().execute(
+                "SELECT COUNT(*) FROM jobs WHERE client_id = ? AND status IN ('queued', 'running') AND created > ?",
+                (client_id, time.time() - self.ttl_seconds)
+            ).fetchone()[0]
+
+    def purge(self):
+        """Delete the expired jobs, and the unfinished ones of workers that died."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM jobs WHERE finished < ? OR (finished IS NULL AND created < ?)", (cutoff, cutoff))
+            db.commit()
+
+# -------- JOB QUEUE --------
+class JobQueue:
+    """
+    Bounded queue of /ask jobs answered by a fixed pool of worker threads.
+
+    Every client has its own FIFO and the workers take jobs from the clients round-robin, so one client
+    sending many questions can't delay everyone else. Finished jobs are kept for ttl_seconds to be polled.
+
+    With several worker processes (gunicorn) each one runs the jobs it queued, with its own max_depth and
+    fairness, while the job status, results and the per-client limit go through the shared store.
+    """
+
+    def __init__(self, workers, max_depth, max_per_client, ttl_seconds, store):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_per_client = max_per_client
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._queues = OrderedDict() # client id -> deque of queued jobs, next client to serve first
+        self._jobs = {} # job id -> Job, queued, running and finished ones
+        self._active = {} # client id -> queued + running jobs
+        self._depth = 0
+        self._running = 0
+        self._threads = []
+
+    def _start(self):
+        """Start the worker threads on first use (not at import, so scripts and reloader parents don't run any)."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ask-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _purge(self):
+        """Forget finished jobs older than ttl_seconds. Caller must hold the lock."""
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished is not None and now - job.finished > self.ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, client_id, compute, cached=None):
+        """
+        Queue compute() for client_id.
+
+        Args:
+            client_id (str): Identifies the client for fairness and its job limit.
+            compute (callable): Function with no arguments that returns the result.
+            cached: A result that is already known (e.g. from the answer cache). The job is returned finished.
+
+        Returns:
+            Job: The new job.
+
+        Raises:
+            QueueFullError: If the queue or the client's share of it is full.
+        """
+        job = Job(client_id, compute)
+        with self._lock:
+            self._purge()
+            self.store.purge()
+
+            if cached is not None:
+                job.status, job.result, job.finished = "done", cached, time.monotonic()
+                job.done.set()
+                self._jobs[job.id] = job
+                self.store.save(job)
+                return job
+
+            if self._depth >= self.max_depth:
+                raise QueueFullError(f"The queue is full ({self.max_depth} questions waiting).")
+            if max(self._active.get(client_id, 0), self.store.active(client_id)) >= self.max_per_client:
+                raise QueueFullError(f"Too many questions in progress for this client (max {self.max_per_client}).")
+
+            self._start()
+            self.store.save(job) # before it can run, a worker thread saves it again when it starts and finishes
+            self._queues.setdefault(client_id, deque()).append(job)
+            self._jobs[job.id] = job
+            self._active[client_id] = self._active.get(client_id, 0) + 1
+            self._depth += 1
+            self._ready.notify()
+        return job
+
+    def _next_job(self):
+        """Take the next job round-robin over the clients, waiting for one. Caller must hold the lock."""
+        while not self._queues:
+            self._ready.wait()
+
+        client_id, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(client_id) # the client's next job goes after every other client's
+        else:
+            del self._queues[client_id]
+
+        self._depth -= 1
+        self._running += 1
+        job.status = "running"
+        return job
+
+    def _work(self):
+        """Worker thread loop."""
+        while True:
+            with self._lock:
+                job = self._next_job()
+            self._save(job)
+
+            try:
+                job.result = job.compute()
+                job.status = "done"
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.error = "Failed to answer the question."
+                job.status = "error"
+
+            with self._lock:
+                job.compute = None
+                job.finished = time.monotonic()
+                self._running -= 1
+                self._active[job.client_id] -= 1
+                if not self._active[job.client_id]:
+                    del self._active[job.client_id]
+            self._save(job)
+            job.done.set()
+
+    def _save(self, job):
+        """Write the job to the store. A failed write is only logged, the job still finishes in this process."""
+        try:
+            self.store.save(job)
+        except sqlite3.Error as e:
+            print(f"Saving job {job.id} failed: {e}")
+
+    def get(self, job_id):
+        """Return the job, or None if it doesn't exist or expired. Jobs of other worker processes come from the store."""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+        return job if job is not None else self.store.load(job_id)
+
+    def wait(self, job_id, timeout):
+        """Long-poll: return the job once it finished or after timeout seconds, or None if it doesn't exist."""
+        job = self.get(job_id)
+        if job is None or timeout <= 0:
+            return job
+
+        with self._lock:
+            local = self._jobs.get(job_id) is job
+        if local:
+            job.done.wait(timeout)
+            return job
+
+        # run by another worker process: poll the store
+        deadline = time.monotonic() + timeout
+        while not job.done.is_set() and time.monotonic() < deadline:
+            time.sleep(min(JOB_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+            job = self.store.load(job_id) or job
+        return job
+
+    def position(self, job):
+        """Number of queued jobs served before a queued job (round-robin order), None if it's not queued."""
+        with self._lock:
+            if job.status != "queued":
+                return None
+            queue = self._queues.get(job.client_id)
+            if not queue or job not in queue:
+                return None
+
+            # every client ahead gets one job per round
+            rounds = queue.index(job)
+            ahead = 0
+            for client_id, other in self._queues.items():
+                if client_id == job.client_id:
+                    ahead += rounds
+                    continue
+                ahead += min(len(other), rounds + (1 if self._is_before(client_id, job.client_id) else 0))
+            return ahead
+
+    def _is_before(self, client_a, client_b):
+        """True if client_a is served before client_b in the current round. Caller must hold the lock."""
+        for client_id in self._queues:
+            if client_id == client_a:
+                return True
+            if client_id == client_b:
+                return False
+        return False
+
+    def stats(self):
+        """Queue depth, running jobs and kept jobs."""
+        with self._lock:
+            return {"queued": self._depth, "running": self._running, "clients": len(self._queues), "jobs": len(self._jobs)}
+
+# Create the queue once (outside function, at server startup). The workers start with the first job.
+job_queue = JobQueue(JOB_WORKERS, JOB_MAX_QUEUE_DEPTH, JOB_MAX_PER_CLIENT, JOB_RESULT_TTL_SECONDS, JobStore(JOB_STORE_FILE, JOB_RESULT_TTL_SECONDS))
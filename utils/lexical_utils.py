@@ -0,0 +1,135 @@
+# -------- IMPORTS --------
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+
+# -------- CONFIG --------
+from utils.config_utils import BM25_K1, BM25_B, RRF_K
+
+# words (with apostrophes) and rule numbers like "704.5a" as single tokens
+TOKEN_PATTERN = re.compile(r"\d{1,3}(?:\.\d+[a-z]?)?|[a-z]+(?:'[a-z]+)?")
+# explicit rule references in a question: "704.5a", "rule 704.5", "rule 702"
+RULE_REFERENCE_PATTERN = re.compile(r"\b(\d{3}\.\d+[a-z]?)\b|\brules? (\d{3})\b(?!\.\d)", re.I)
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "has", "have", "how", "i", "if",
+    "in", "is", "it", "its", "of", "on", "or", "that", "the", "their", "then", "there", "this", "to", "was", "what",
+    "when", "where", "which", "who", "will", "with", "would", "you", "your", "rule", "rules", "see"
+}
+
+# -------- HELPER TOKENIZE --------
+def tokenize(text):
+    """Lowercase word and rule-number tokens of a text, without stopwords."""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+# -------- HELPER FIND RULE REFERENCES --------
+def find_rule_references(text):
+    """Rule ids explicitly named in a text ("rule 704.5a", "702.19b"), in order and without duplicates."""
+    refs = []
+    for match in RULE_REFERENCE_PATTERN.finditer(text):
+        rule_id = (match.group(1) or match.group(2)).lower()
+        if rule_id not in refs:
+            refs.append(rule_id)
+    return refs
+
+# -------- HELPER ONLY RULE REFERENCES --------
+def only_rule_references(text):
+    """True if a text names rules and has no other meaningful words ("rule 704.5a", "704.5a and 704.5b")."""
+    if not find_rule_references(text):
+        return False
+    remainder = RULE_REFERENCE_PATTERN.sub(" ", text)
+    return not tokenize(remainder)
+
+# -------- HELPER RECIPROCAL RANK FUSION --------
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Fuse several rankings of ids with reciprocal-rank fusion: score(id) = sum(1 / (k + rank)).
+
+    Args:
+        rankings (list[list[str]]): Ranked ids, best first, one list per retriever.
+        k (int): RRF constant. Higher values flatten the difference between top and lower ranks.
+
+    Returns:
+        list[str]: Ids sorted by fused score, best first.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+# -------- BM25 INDEX --------
+class BM25Index:
+    """
+    Local BM25 inverted index over the same chunks as the vector index (same ids).
+    Also maps rule ids to their chunks, so explicit rule references resolve without any search.
+    """
+
+    def __init__(self, ids, texts, metas):
+        self.ids = ids
+        self.texts = texts
+        self.metas = metas
+
+        self.postings = defaultdict(list) # term -> [(doc index, term frequency)]
+        self.lengths = []
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings[term].append((i, tf))
+
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        n = len(texts)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+
+        self.by_rule = defaultdict(list) # rule id -> doc indexes, in chunk order
+        for i, meta in enumerate(metas):
+            rule_ids = meta["children"].split(",") if meta.get("children") else [meta.get("rule_id")]
+            if meta.get("children"):
+                # sections ("702") are no chunks of their own, a parent is found under the section of its rules too
+                rule_ids = list(dict.fromkeys(rule_ids + [rule_ids[0].split(".")[0]]))
+            for rule_id in rule_ids:
+                if rule_id:
+                    self.by_rule[rule_id].append(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k):
+        """Return the k best (doc index, score) pairs for a query."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.avg_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+    def rule_chunks(self, rule_id):
+        """Doc indexes of the chunks of a rule and its subrules ("704.5" also returns 704.5a, 704.5b..., "702" every chunk of the section)."""
+        if "." in rule_id and not rule_id[-1].isalpha():
+            subrules = [r for r in self.by_rule if r.startswith(rule_id) and r[len(rule_id):].isalpha()]
+            # a parent chunk holds a rule with its subrules, so keep each chunk once
+            return list(dict.fromkeys(self.by_rule.get(rule_id, []) + [i for r in sorted(subrules) for i in self.by_rule[r]]))
+        return list(self.by_rule.get(rule_id, []))
+
+    def doc(self, i):
+        """Chunk i in the same format as search_index results."""
+        return {"id": self.ids[i], "text": self.texts[i], "metadata": self.metas[i]}
+
+    def save(self, path):
+        """Store the chunks (the postings are rebuilt on load, which takes well under a second)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "metas": self.metas}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index stored with save()."""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["texts"], data["metas"])
@@ -0,0 +1,247 @@
+# -------- IMPORTS --------
+import time
+import asyncio
+import threading
+from collections import defaultdict
+from openai import OpenAI, AsyncOpenAI
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+
+try:
+    import tiktoken # optional, exact token counts for the context budgets
+except ImportError:
+    tiktoken = None
+
+# -------- CONFIG --------
+from utils.config_utils import OPENAI_API_KEY, OPENAI_BASE_URL, CHAT_MODEL, EMBED_MODEL, CHAT_COMPLETION_TOKENS_ESTIMATE, EMBED_HEDGE_AFTER_SECONDS, EMBED_HEDGE_MAX_TEXTS
+from utils.metrics_utils import metrics, span
+from utils.throttle_utils import CallPolicy, estimate_tokens, rate_limiters
+
+# -------- INITIALIZATION --------
+# OpenAI clients, created on first use (after the fork in a preloaded multi-worker server)
+client = None
+async_client = None
+embed_hedge_after = EMBED_HEDGE_AFTER_SECONDS
+
+# Threads of the (sync) embedding requests while they can be hedged
+hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="openai-hedge")
+
+# Token usage per stage since startup: stage -> {"calls", "prompt_tokens", "cached_tokens", "completion_tokens"}
+usage_totals = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+usage_lock = threading.Lock()
+
+_encoding = None
+
+# -------- HELPER COUNT TOKENS --------
+def count_tokens(text):
+    """Number of tokens of a text for CHAT_MODEL (approximated as 4 characters per token without tiktoken)."""
+    global _encoding
+
+    if _encoding is None and tiktoken is not None:
+        try:
+            try:
+                _encoding = tiktoken.encoding_for_model(CHAT_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e: # the encoding is downloaded on first use, don't fail requests when offline
+            print(f"tiktoken encoding unavailable ({type(e).__name__}), estimating token counts")
+            _encoding = False
+
+    if not _encoding:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+# -------- HELPER RECORD USAGE --------
+def record_usage(stage, usage):
+    """Log and accumulate the token usage of a chat call."""
+    if usage is None:
+        return
+
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+    with usage_lock:
+        totals = usage_totals[stage]
+        totals["calls"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["cached_tokens"] += cached
+        totals["completion_tokens"] += usage.completion_tokens
+
+    metrics.inc("mtg_llm_tokens_total", usage.prompt_tokens, stage=stage, kind="prompt")
+    metrics.inc("mtg_llm_tokens_total", cached, stage=stage, kind="cached")
+    metrics.inc("mtg_llm_tokens_total", usage.completion_tokens, stage=stage, kind="completion")
+
+    print(f"[{stage}] prompt tokens: {usage.prompt_tokens} (cached: {cached}), completion tokens: {usage.completion_tokens}")
+
+# -------- HELPER CLIENTS --------
+# no retries in the clients, the calls below retry within the stage deadlines (see OPENAI CALL VARIABLES)
+def get_client():
+    """Return the OpenAI client, creating it on first use."""
+    global client
+    if client is None:
+        client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+    return client
+
+def get_async_client():
+    """Return the async OpenAI client of the concurrent pipeline (utils/async_utils.py), creating it on first use."""
+    global async_client
+    if async_client is None:
+        async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+    return async_client
+
+# -------- HELPER SCHEDULED CALL --------
+def scheduled_call(kind, stage, tokens, send):
+    """
+    Run send(timeout) under the shared rate limits, the deadline of the stage and its retry policy (see throttle_utils).
+    Returns what send returns.
+    """
+    policy = CallPolicy(kind, stage, tokens)
+    while True:
+        wait = policy.acquire()
+        if wait:
+            with span("mtg_call_seconds", call="rate_limit_wait", stage=stage):
+                time.sleep(wait)
+        try:
+            return send(policy.timeout())
+        except Exception as e:
+            time.sleep(policy.retry_delay(e))
+
+async def ascheduled_call(kind, stage, tokens, send):
+    """Same as scheduled_call for a coroutine function send(timeout)."""
+    policy = CallPolicy(kind, stage, tokens)
+    while True:
+        wait = policy.acquire()
+        if wait:
+            with span("mtg_call_seconds", call="rate_limit_wait", stage=stage):
+                await asyncio.sleep(wait)
+        try:
+            return await send(policy.timeout())
+        except Exception as e:
+            await asyncio.sleep(policy.retry_delay(e))
+
+# -------- HELPER CHAT TOKENS --------
+def chat_tokens(kwargs):
+    """Estimated tokens of a chat call (prompt and completion) for the rate limiter."""
+    prompt = estimate_tokens(m["content"] for m in kwargs.get("messages", []) if isinstance(m.get("content"), str))
+    return prompt + (kwargs.get("max_tokens") or CHAT_COMPLETION_TOKENS_ESTIMATE)
+
+# -------- HELPER CHAT --------
+def chat(stage, **kwargs):
+    """Chat completion for a pipeline stage. Returns the response text and records its token usage."""
+    with span("mtg_call_seconds", call="openai_chat", stage=stage):
+        resp = scheduled_call("chat", stage, chat_tokens(kwargs), lambda timeout: get_client().chat.completions.create(timeout=timeout, **kwargs))
+    record_usage(stage, getattr(resp, "usage", None))
+    return resp.choices[0].message.content
+
+# -------- HELPER ASYNC CHAT --------
+async def achat(stage, **kwargs):
+    """Same as chat, with the async client."""
+    async def send(timeout):
+        return await get_async_client().chat.completions.create(timeout=timeout, **kwargs)
+
+    with span("mtg_call_seconds", call="openai_chat", stage=stage):
+        resp = await ascheduled_call("chat", stage, chat_tokens(kwargs), send)
+    record_usage(stage, getattr(resp, "usage", None))
+    return resp.choices[0].message.content
+
+# -------- HELPER CHAT STREAM --------
+def chat_stream(stage, **kwargs):
+    """
+    Streamed chat completion for a pipeline stage. Yields the text deltas and records the token usage at the end.
+    The timing span covers the whole stream, including the time the caller spends on each delta.
+    Only opening the stream is retried; the deadline of the stage also bounds the wait for each chunk.
+    """
+    with span("mtg_call_seconds", call="openai_chat_stream", stage=stage):
+        stream = scheduled_call(
+            "chat", stage, chat_tokens(kwargs),
+            lambda timeout: get_client().chat.completions.create(stream=True, stream_options={"include_usage": True}, timeout=timeout, **kwargs)
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None):
+                record_usage(stage, chunk.usage)
+
+# -------- HELPER CREATE EMBEDDINGS --------
+def create_embeddings(texts, stage="embeddings"):
+    """
+    Embeddings API call with EMBED_MODEL. Returns the raw response.
+    A small request (at most EMBED_HEDGE_MAX_TEXTS texts) slower than embed_hedge_after seconds is sent a second time
+    and the first answer wins. stage picks the deadline: "embeddings" for questions, "index_embeddings" for index builds.
+    """
+    def send(timeout):
+        request = lambda: get_client().embeddings.create(model=EMBED_MODEL, input=texts, timeout=timeout)
+        if not should_hedge(texts):
+            return request()
+        return hedged(request, embed_hedge_after, texts)
+
+    with span("mtg_call_seconds", call="openai_embeddings", stage=stage):
+        return scheduled_call("embeddings", stage, estimate_tokens(texts), send)
+
+# -------- HELPER ASYNC CREATE EMBEDDINGS --------
+async def acreate_embeddings(texts, stage="embeddings"):
+    """Same as create_embeddings, with the async client."""
+    async def send(timeout):
+        request = lambda: get_async_client().embeddings.create(model=EMBED_MODEL, input=texts, timeout=timeout)
+        if not should_hedge(texts):
+            return await request()
+        return await ahedged(request, embed_hedge_after, texts)
+
+    with span("mtg_call_seconds", call="openai_embeddings", stage=stage):
+        return await ascheduled_call("embeddings", stage, estimate_tokens(texts), send)
+
+# -------- HELPER HEDGED --------
+def should_hedge(texts):
+    """True for embeddings requests worth hedging: small ones on the latency path. Big batches would be paid twice."""
+    return bool(embed_hedge_after) and len(texts) <= EMBED_HEDGE_MAX_TEXTS
+
+def hedge_started(after, texts):
+    """Count and log a hedge request, and take it from the rate limiters (without waiting, it's already late)."""
+    requests, tokens = rate_limiters["embeddings"]
+    requests.reserve(1)
+    tokens.reserve(estimate_tokens(texts))
+    metrics.inc("mtg_openai_hedges_total", outcome="sent")
+    print(f"Embeddings request of {len(texts)} texts slower than {after}s, hedging")
+
+def hedged(request, after, texts):
+    """
+    Call request() on the hedge pool. If it hasn't answered after `after` seconds, call it a second time and
+    return whichever answers first (the slower one is left to finish in the background). Fails only if both fail.
+    """
+    primary = hedge_pool.submit(request)
+    try:
+        return primary.result(timeout=after)
+    except FutureTimeoutError:
+        pass
+
+    hedge_started(after, texts)
+    hedge = hedge_pool.submit(request)
+    error = None
+    for future in as_completed([primary, hedge]):
+        if future.exception() is None:
+            metrics.inc("mtg_openai_hedges_total", outcome="hedge_won" if future is hedge else "primary_won")
+            return future.result()
+        error = error or future.exception()
+    raise error
+
+async def ahedged(request, after, texts):
+    """Same as hedged for a coroutine function request(). The slower request is cancelled."""
+    primary = asyncio.ensure_future(request())
+    done, _ = await asyncio.wait({primary}, timeout=after)
+    if done:
+        return primary.result()
+
+    hedge_started(after, texts)
+    hedge = asyncio.ensure_future(request())
+    pending, error = {primary, hedge}, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    metrics.inc("mtg_openai_hedges_total", outcome="hedge_won" if task is hedge else "primary_won")
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
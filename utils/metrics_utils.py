@@ -0,0 +1,136 @@
+# -------- IMPORTS --------
+import time
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+# -------- CONFIG --------
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80) # seconds, upper bounds of the latency histograms
+
+# Every exported metric: name -> (type, help)
+METRICS = {
+    "mtg_request_seconds": ("histogram", "Latency of API requests by endpoint."),
+    "mtg_stage_seconds": ("histogram", "Latency of the answer pipeline stages (subqueries, retrieval, context, judge1, judge2, refinement)."),
+    "mtg_call_seconds": ("histogram", "Latency of each OpenAI and Chroma call."),
+    "mtg_llm_tokens_total": ("counter", "Chat completion tokens by stage and kind (prompt, cached, completion)."),
+    "mtg_embedding_tokens_total": ("counter", "Embedding tokens sent to the API (cache misses only)."),
+    "mtg_judge_verdicts_total": ("counter", "Second judge verdicts (accepted or denied)."),
+    "mtg_speculation_total": ("counter", "Refinement contexts prefetched during the second judge, by outcome (used on a denial, wasted on Accepted, failed)."),
+    "mtg_openai_throttled_total": ("counter", "OpenAI calls delayed by the process rate limiter, by kind (chat, embeddings)."),
+    "mtg_openai_throttle_seconds": ("histogram", "Time OpenAI calls waited for the process rate limiter."),
+    "mtg_openai_retries_total": ("counter", "Retried OpenAI calls by kind and error."),
+    "mtg_openai_deadline_exceeded_total": ("counter", "OpenAI calls given up at the deadline of their stage."),
+    "mtg_openai_hedges_total": ("counter", "Hedged embeddings requests (sent, primary_won, hedge_won)."),
+    "mtg_errors_total": ("counter", "Failed requests by endpoint."),
+    "mtg_ask_mode_total": ("counter", "/ask requests by execution mode and how it was picked."),
+    "mtg_answer_cache": ("gauge", "Answer cache counters since startup (hits, misses, coalesced, items)."),
+    "mtg_embedding_cache": ("gauge", "Embedding cache counters since startup (memory_hits, disk_hits, misses, memory_items)."),
+    "mtg_process_memory_bytes": ("gauge", "Memory of this worker process (rss, and pss: shared pages split between the processes sharing them)."),
+    "mtg_startup_seconds": ("gauge", "Load time of each component in this process, 0 if preloaded by the master; ready: from start to the first passing /readyz."),
+    "mtg_job_queue": ("gauge", "Async /ask jobs (queued, running, clients with queued jobs, jobs kept)."),
+}
+
+# Spans of the request being timed in this context (set by request_timings)
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+# -------- HELPER FORMAT LABELS --------
+def format_labels(labels):
+    """Prometheus label set, e.g. {stage="judge1"}. labels is a tuple of (name, value) pairs."""
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+# -------- METRICS REGISTRY --------
+class MetricsRegistry:
+    """
+    Thread-safe in-process counters, gauges and latency histograms, rendered in the Prometheus text format.
+    Each gunicorn/Flask worker process keeps its own values.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = defaultdict(dict) # name -> {labels: value} for counters and gauges
+        self._histograms = defaultdict(dict) # name -> {labels: [bucket counts..., sum, count]}
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = self._values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, seconds, **labels):
+        """Record a latency in a histogram."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            hist = self._histograms[name].get(key)
+            if hist is None:
+                hist = self._histograms[name][key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in METRICS.items():
+                if name not in self._values and name not in self._histograms:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                for labels, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+                for labels, hist in sorted(self._histograms.get(name, {}).items()):
+                    for bound, count in zip(self.buckets, hist):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {hist[-2]:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {hist[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+# Create the registry once (outside function, at server startup)
+metrics = MetricsRegistry()
+
+# -------- HELPER SPAN --------
+@contextmanager
+def span(metric, **labels):
+    """
+    Time a block into the `metric` histogram with the given labels,
+    and into the timing breakdown of the current request if one is being recorded.
+
+    Example: with span("mtg_stage_seconds", stage="judge1"): ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(metric, elapsed, **labels)
+
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append({**labels, "ms": round(elapsed * 1000, 1)})
+
+# -------- HELPER REQUEST TIMINGS --------
+@contextmanager
+def request_timings():
+    """Collect the spans of everything run inside the block. Yields the list the spans are appended to."""
+    spans = []
+    token = _request_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _request_spans.reset(token)
@@ -0,0 +1,57 @@
+# -------- IMPORTS --------
+import re
+
+# -------- CONFIG --------
+from utils.config_utils import ASK_MODES, DEFAULT_ASK_MODE, MODE_LATENCY_BUDGETS_MS
+
+# words of questions about interactions that usually need the full pipeline
+COMPLEX_TERMS = re.compile(
+    r"\b(stack|priority|in response|respond\w*|trigger\w*|replacement|instead|layers?|copy|copies|gain control|"
+    r"state-based|simultaneous\w*|loop|infinite|first strike|double strike|prevent\w*|until end of turn|timestamp)\b",
+    re.I
+)
+
+# -------- HELPER CLASSIFY MODE --------
+def classify_mode(question, cards_info):
+    """
+    Cheap heuristic (no API call) to pick the mode of a question: longer questions, more cards
+    and interaction terms (stack, triggers, replacement effects...) go to the slower, more careful modes.
+    """
+    score = 0
+    words = len(question.split())
+    score += (words > 25) + (words > 60)
+    score += (len(cards_info) >= 2) + (len(cards_info) >= 3)
+    score += min(len({m.lower() for m in COMPLEX_TERMS.findall(question)}), 3)
+
+    if score <= 1:
+        return "fast"
+    if score <= 3:
+        return "balanced"
+    return "thorough"
+
+# -------- HELPER RESOLVE MODE --------
+def resolve_mode(question, cards_info, mode=None, latency_budget_ms=None):
+    """
+    Mode an /ask request runs in: the requested mode, else the one that fits latency_budget_ms,
+    else DEFAULT_ASK_MODE. "auto" (requested or default) uses classify_mode.
+
+    Returns:
+        tuple[str, str]: (mode, how it was picked: "request", "latency_budget", "auto" or "default").
+    """
+    source = "request"
+    if mode is None and latency_budget_ms is not None:
+        for name, budget in sorted(MODE_LATENCY_BUDGETS_MS.items(), key=lambda item: item[1]):
+            if latency_budget_ms < budget:
+                return name, "latency_budget"
+        return "thorough", "latency_budget"
+
+    if mode is None:
+        mode, source = DEFAULT_ASK_MODE, "default"
+    if mode == "auto":
+        return classify_mode(question, cards_info), "auto"
+    return mode, source
+
+# -------- HELPER VALID MODE --------
+def is_valid_mode(mode):
+    """True for the modes of ASK_MODES and "auto". Any other JSON value (list, object, number...) is invalid."""
+    return isinstance(mode, str) and (mode == "auto" or mode in ASK_MODES)
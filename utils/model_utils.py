@@ -4,55 +4,244 @@ import json
 import os
 
 # -------- CONFIG --------
-from utils.config_utils import TOP_K, CHAT_MODEL, CHROMA_DB_DIR, EMBED_MODEL, CLIENT, MAX_CONTENT_CHUNKS, MAX_SUBQUERIES, MODEL_HIGH_TEMPERATURE, MODEL_LOW_TEMPERATURE, CARDS_FILE, RULES_FILE
+from utils.config_utils import TOP_K, CHAT_MODEL, CHROMA_DB_DIR, MAX_SUBQUERIES, MODEL_HIGH_TEMPERATURE, MODEL_LOW_TEMPERATURE, RULES_FILE, RETRIEVAL_BACKEND, HYBRID_SEARCH, LEXICAL_INDEX_FILE, REFINEMENT_CONTEXT_TOKEN_BUDGET, CARD_RULINGS_COLLECTION, CARD_RULINGS_PER_CARD, AUTO_DETECT_CARDS, AUTO_DETECT_MAX_CARDS, ASK_MODES
+from utils.card_utils import get_card_store
+from utils.embedding_utils import embed_texts
+from utils.rules_utils import RulesIndex
+from utils.index_utils import get_active_collection_name, build_lexical_index, expand_chunk_text, content_hash, ruling_text
+from utils.lexical_utils import BM25Index, find_rule_references, only_rule_references, reciprocal_rank_fusion
+from utils.vector_utils import NumpyVectorStore, get_current_export_dir
+from utils.context_utils import select_context, assemble_context, reference_chunks
+from utils.llm_utils import chat, chat_stream
+from utils.metrics_utils import metrics, span
+
+# Chroma client and collections, opened on first use in each process (a Chroma client can't be shared across a fork)
+chroma_client = None
+chroma_pid = None
+rules_collection = None
+rules_collection_name = None
+card_rulings_collection = None
+
+# Rules parsed on first use, or before the workers fork (see utils/state_utils.py)
+rules_index = None
+
+# Exported vectors for RETRIEVAL_BACKEND = "numpy", loaded on first use
+vector_store = None
+
+# BM25 index of the same chunks for HYBRID_SEARCH, loaded on first use
+lexical_index = None
+lexical_index_mtime = None
+
+# -------- HELPER CHROMA CLIENT --------
+def get_chroma_client():
+    """Return the Chroma client of this process, opening it on first use (and again in a forked worker)."""
+    global chroma_client, chroma_pid, rules_collection, rules_collection_name, card_rulings_collection
+
+    if chroma_client is None or chroma_pid != os.getpid():
+        chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+        chroma_pid = os.getpid()
+        rules_collection = rules_collection_name = card_rulings_collection = None
+
+    return chroma_client
+
+# -------- HELPER RULES COLLECTION --------
+def get_rules_collection():
+    """Return the live rules collection, switching over when build_index swaps in a new one."""
+    global rules_collection, rules_collection_name
+
+    client = get_chroma_client()
+    name = get_active_collection_name()
+    if rules_collection is None or name != rules_collection_name:
+        rules_collection = client.get_or_create_collection(name=name)
+        rules_collection_name = name
+        print(f"Opened rules collection {name} ({rules_collection.count()} documents)")
+
+    return rules_collection
+
+# -------- HELPER CARD RULINGS COLLECTION --------
+def get_card_rulings_collection():
+    """Return the card rulings collection, opening it on first use."""
+    global card_rulings_collection
+
+    client = get_chroma_client()
+    if card_rulings_collection is None:
+        card_rulings_collection = client.get_or_create_collection(name=CARD_RULINGS_COLLECTION)
+        print(f"Opened card rulings collection ({card_rulings_collection.count()} documents)")
+
+    return card_rulings_collection
+
+# -------- HELPER RULES INDEX --------
+def get_rules_index():
+    """Return the parsed comprehensive rules, parsing them on first use."""
+    global rules_index
+
+    if rules_index is None:
+        rules_index = RulesIndex.from_file(RULES_FILE)
+        print("Total rules in rules index:", len(rules_index))
+
+    return rules_index
+
+# -------- HELPER VECTOR STORE --------
+def get_vector_store():
+    """Return the NumpyVectorStore of the current export, reloading it when a new export is published."""
+    global vector_store
+
+    export_dir = get_current_export_dir()
+    if export_dir is None:
+        raise RuntimeError("No vector export found. Run scripts/export_vectors.py or use RETRIEVAL_BACKEND = 'chroma'.")
+
+    if vector_store is None or vector_store.export_dir != export_dir:
+        vector_store = NumpyVectorStore(export_dir)
+        print(f"Loaded vector export {export_dir} ({len(vector_store)} vectors)")
+
+    return vector_store
+
+# -------- HELPER LEXICAL INDEX --------
+def get_lexical_index():
+    """Return the BM25 index written by build_index, reloading it when a new one is written."""
+    global lexical_index, lexical_index_mtime
 
-# Initialize Chroma once (outside function, at server startup)
-chroma_client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
-rules_collection = chroma_client.get_or_create_collection(name="mtg_data")
-print("Total documents in collection:", rules_collection.count())
-
-# -------- INITIALIZATION --------
-client = CLIENT
+    try:
+        mtime = os.path.getmtime(LEXICAL_INDEX_FILE)
+    except OSError:
+        mtime = None
+
+    if lexical_index is None or mtime != lexical_index_mtime:
+        if mtime is not None:
+            lexical_index = BM25Index.load(LEXICAL_INDEX_FILE)
+        else:
+            # index built before the BM25 index existed: build it from the chunks of the vector index itself,
+            # their ids may differ from the ones prepare_chunks gives today and the fusion matches hits by id
+            lexical_index = build_lexical_index(*vector_index_chunks())
+        lexical_index_mtime = mtime
+        print(f"Loaded BM25 index ({len(lexical_index)} chunks)")
+
+    return lexical_index
+
+# -------- HELPER VECTOR INDEX CHUNKS --------
+def vector_index_chunks():
+    """(ids, documents, metadatas) of every chunk of the index RETRIEVAL_BACKEND queries."""
+    if RETRIEVAL_BACKEND == "numpy":
+        store = get_vector_store()
+        ids, documents, metadatas = store.ids, store.documents, store.metadatas
+    else:
+        chunks = get_rules_collection().get(include=["documents", "metadatas"])
+        ids, documents, metadatas = chunks["ids"], chunks["documents"], chunks["metadatas"]
+    return list(ids), list(documents), [meta or {} for meta in metadatas]
+
+# -------- HELPER QUERY VECTORS --------
+def query_vectors(vecs, n_results):
+    """Top-k search of query vectors on the configured RETRIEVAL_BACKEND. Returns a Chroma-like result, distances are 1 - cosine on both."""
+    with span("mtg_call_seconds", call=f"{RETRIEVAL_BACKEND}_query", stage="retrieval"):
+        if RETRIEVAL_BACKEND == "numpy":
+            return get_vector_store().query(vecs, n_results)
+
+        collection = get_rules_collection()
+        results = collection.query(query_embeddings=vecs, n_results=n_results)
+        if (collection.metadata or {}).get("hnsw:space", "l2") == "l2" and results.get("distances"):
+            # collection built before the cosine space: the squared L2 distance of unit vectors is 2 * (1 - cosine)
+            results["distances"] = [[d / 2 for d in row] for row in results["distances"]]
+        return results
 
 # -------- HELPER SEARCH INDEX --------
 def search_index(query):
-    """Search ChromaDB for relevant rule chunks."""
+    """Search the rules index for relevant rule chunks."""
 
     query = query.strip()
     if not query:
         raise ValueError("Empty query provided.")
 
-    # Create embedding
-    emb = client.embeddings.create(model=EMBED_MODEL, input=[query])
-    vec = emb.data[0].embedding
+    return search_index_batch([query])[0]
 
-    # Query Chroma
-    results = rules_collection.query(query_embeddings=[vec], n_results=TOP_K)
+# -------- HELPER SEARCH INDEX BATCH --------
+def search_index_batch(queries, top_k=TOP_K):
+    """
+    Search the rules index for relevant rule chunks of several queries at once.
+    All queries are embedded in a single embeddings request and sent to the index (RETRIEVAL_BACKEND) in a single query.
+    With HYBRID_SEARCH, vector hits are fused with local BM25 hits, and queries that only name rules skip the embedding call.
 
-    docs = []
+    Args:
+        queries (list[str]): The queries to search for.
+        top_k (int): Chunks per query.
 
-    documents = results.get("documents", [])
-    metadatas = results.get("metadatas", [])
+    Returns:
+        list[list[dict]]: The rule chunks found for each query, in the same order as queries. Empty queries get no chunks.
+    """
 
-    if documents:
-        documents = documents[0]
-    if metadatas:
-        metadatas = metadatas[0]
+    queries = [q.strip() for q in queries]
+    if not any(queries):
+        return [[] for _ in queries]
+
+    # queries that only name rules ("rule 704.5a") are resolved by the BM25 index, without an embedding call
+    lexical = get_lexical_index() if HYBRID_SEARCH else None
+    batch = [q for q in queries if q and not (lexical and only_rule_references(q))]
+
+    vector_hits = {}
+    if batch:
+        # Create all embeddings in one request (cached ones don't hit the API)
+        vecs = embed_texts(batch)
+
+        # Query the index with all embeddings at once
+        results = query_vectors(vecs, top_k)
+
+        ids = results.get("ids") or [[] for _ in batch]
+        documents = results.get("documents") or [[] for _ in batch]
+        metadatas = results.get("metadatas") or [[] for _ in batch]
+        distances = results.get("distances") or [[None] * len(ids_i) for ids_i in ids]
+
+        for q, ids_i, docs_i, metas_i, dists_i in zip(batch, ids, documents, metadatas, distances):
+            vector_hits[q] = [
+                {
+                    "id": doc_id,
+                    "text": expand_chunk_text(doc, meta, get_rules_index().texts), # rules parents are embedded compact, return their children
+                    "metadata": meta,  # keep Chroma’s default key
+                    "distance": float(dist) if dist is not None else None
+                }
+                for doc_id, doc, meta, dist in zip(ids_i, docs_i, metas_i, dists_i)
+            ]
 
-    for doc, meta in zip(documents, metadatas):
-        docs.append({
-            "text": doc,
-            "metadata": meta  # keep Chroma’s default key
-        })
-    
-    return docs
+    if lexical is None:
+        return [vector_hits.get(q, []) if q else [] for q in queries]
 
-# -------- HELPER GENERATE SUBQUERIES --------
-def generate_subqueries(query):
-    """Chain of Thought decomposition function. Use the LLM to break a user query into smaller sub-questions."""
-    #client = OpenAI(api_key=OPENAI_API_KEY)
-    prompt = f"""
-    Break down the following Magic: The Gathering rules question into up to {MAX_SUBQUERIES*2} smaller, 
+    return [hybrid_hits(q, vector_hits.get(q, []), lexical, top_k) if q else [] for q in queries]
+
+# -------- HELPER HYBRID HITS --------
+def hybrid_hits(query, vector_docs, lexical, top_k=TOP_K):
+    """
+    Fuse the vector hits of a query with its BM25 hits (reciprocal-rank fusion). Chunks of explicitly named rules come first,
+    in rule order and at most top_k of them ("rule 702" names a whole section).
+    """
+    direct = [lexical.doc(i) for rule_id in find_rule_references(query) for i in lexical.rule_chunks(rule_id)]
+    keyword = [lexical.doc(i) for i, _ in lexical.search(query, top_k * 2)]
+
+    docs = {d["id"]: d for d in keyword + vector_docs + direct}
+    fused = reciprocal_rank_fusion([[d["id"] for d in vector_docs], [d["id"] for d in keyword]])
+
+    direct_ids = list(dict.fromkeys(d["id"] for d in direct))[:top_k]
+    ranked = list(dict.fromkeys(direct_ids + fused))
+    return [docs[doc_id] for doc_id in ranked[:top_k]]
+
+# -------- HELPER COLLECT RESULTS --------
+def collect_results(subqueries, top_k=TOP_K):
+    """Search the index for all subqueries in one batch and flatten the hits, tagged with their subquery."""
+    all_results = []
+    for sq, results in zip(subqueries, search_index_batch(subqueries, top_k)):
+        for rank, r in enumerate(results):
+            all_results.append({
+                "id": r["id"],
+                "subquery": sq,
+                "source": r["metadata"].get("source", ""),
+                "text": r["text"],
+                "rank": rank,
+                "distance": r.get("distance")
+            })
+    return all_results
+
+# -------- HELPER SUBQUERY PROMPTS --------
+def subqueries_prompt(query, amount):
+    """Prompt asking for up to amount sub-questions of a query."""
+    return f"""
+    Break down the following Magic: The Gathering rules question into up to {amount} smaller, 
     more specific sub-questions that cover timing, abilities, rules interactions, 
     and possible edge cases. Return them as a numbered list.
 
@@ -60,21 +249,11 @@ def generate_subqueries(query):
 
     Original Question: {query}
     """
-    resp = client.chat.completions.create(
-        model=CHAT_MODEL,
-        temperature=MODEL_HIGH_TEMPERATURE,
-        messages=[
-            {"role": "system", "content": "You are an expert MTG judge assistant."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    text = resp.choices[0].message.content
-    subqueries = [line.strip("0123456789. ") for line in text.splitlines() if line.strip()]
 
-    # call gpt again to refine into a smaller number of subqueries. It should select only the most relevant ones
-    if len(subqueries) > MAX_SUBQUERIES:
-        prompt2 = f"""
-        From the following list of sub-questions, select the {MAX_SUBQUERIES} most relevant and important ones to answer the original question. 
+def select_subqueries_prompt(query, subqueries, amount):
+    """Prompt asking for the amount most relevant of the generated sub-questions."""
+    return f"""
+        From the following list of sub-questions, select the {amount} most relevant and important ones to answer the original question. 
         Return them as a numbered list.
 
         Original Question: {query}
@@ -82,16 +261,45 @@ def generate_subqueries(query):
         Sub-questions:
         {json.dumps(subqueries)}
         """
-        resp2 = client.chat.completions.create(
+
+def subquery_messages(prompt):
+    """Chat messages of a subqueries call."""
+    return [
+        {"role": "system", "content": "You are an expert MTG judge assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+def parse_subqueries(text):
+    """Sub-questions of a numbered list answer."""
+    return [line.strip("0123456789. ") for line in text.splitlines() if line.strip()]
+
+# -------- HELPER GENERATE SUBQUERIES --------
+def generate_subqueries(query, max_subqueries=MAX_SUBQUERIES, select=True):
+    """
+    Chain of Thought decomposition function. Use the LLM to break a user query into smaller sub-questions.
+    With select, twice as many are generated and a second call keeps the max_subqueries most relevant ones.
+    """
+    amount = max_subqueries * 2 if select else max_subqueries
+    text = chat(
+        "subqueries",
+        model=CHAT_MODEL,
+        temperature=MODEL_HIGH_TEMPERATURE,
+        messages=subquery_messages(subqueries_prompt(query, amount))
+    )
+    subqueries = parse_subqueries(text)
+
+    if not select:
+        return subqueries[:max_subqueries]
+
+    # call gpt again to refine into a smaller number of subqueries. It should select only the most relevant ones
+    if len(subqueries) > max_subqueries:
+        text2 = chat(
+            "subqueries_select",
             model=CHAT_MODEL,
             temperature=MODEL_HIGH_TEMPERATURE,
-            messages=[
-                {"role": "system", "content": "You are an expert MTG judge assistant."},
-                {"role": "user", "content": prompt2}
-            ]
+            messages=subquery_messages(select_subqueries_prompt(query, subqueries, max_subqueries))
         )
-        text2 = resp2.choices[0].message.content
-        subqueries = [line.strip("0123456789. ") for line in text2.splitlines() if line.strip()]
+        subqueries = parse_subqueries(text2)
 
     return subqueries
 
@@ -115,83 +323,103 @@ def safe_json_parse(text):
         return {"error": "Failed to parse JSON", "raw": text}
 
 # -------- HELPER FETCH CARDS --------
-def fetch_cards_info(selected_cards):
-    """Fetch card details from the local JSON file based on provided names or IDs."""
-    if not os.path.exists(CARDS_FILE):
-        print(f"Card file not found at {CARDS_FILE}")
-        return []
-
-    with open(CARDS_FILE, "r", encoding="utf-8") as f:
-        all_cards = json.load(f)
+def fetch_cards_info(selected_cards, question=None):
+    """
+    Fetch card details from the card store based on provided ids.
+    With AUTO_DETECT_CARDS, the cards named in the question text are added too (up to AUTO_DETECT_MAX_CARDS).
+    """
+    card_store = get_card_store()
+    card_store.reload_if_changed()
 
     # find all cards that match the uuid in selected_cards
     cards_info = []
     for c in selected_cards:
-        for card in all_cards:
-            if c["uuid"] == card["uuid"]:
+        card = card_store.get(c["uuid"])
+        if card is not None:
+            cards_info.append(card)
+
+    if AUTO_DETECT_CARDS and question:
+        selected = {c.get("uuid") for c in cards_info}
+        detected = [uuid for _, uuid in card_store.name_matcher().find(question) if uuid not in selected]
+        for uuid in detected[:AUTO_DETECT_MAX_CARDS]:
+            card = card_store.get(uuid)
+            if card is not None:
                 cards_info.append(card)
-                break
 
     return cards_info
 
-# ---------- ANSWER WITH SUBQUERIES ----------
-def answer_with_subqueries(user_prompt, cards_info):
-    """Break question into subqueries, search index for each, and generate final structured ruling."""
-
-    # Step 1: Generate subqueries
-    subqueries = generate_subqueries(user_prompt)
+# -------- HELPER NEEDS RULING NARROWING --------
+def needs_ruling_narrowing(cards_info):
+    """True if a card has more than CARD_RULINGS_PER_CARD rulings, so retrieve_card_rulings embeds the question too."""
+    return any(len(c.get("rulings") or []) > CARD_RULINGS_PER_CARD for c in cards_info)
 
-    # Step 2: Collect retrieval results
-    all_results = []
-    for sq in subqueries:
-        results = search_index(sq)
-        for r in results:
-            all_results.append({
-                "subquery": sq,
-                "source": r["metadata"].get("source", ""),
-                "text": r["text"]
-            })
-
-    # Prune context if too large
-    if len(all_results) > MAX_CONTENT_CHUNKS:
-        all_results = all_results[:MAX_CONTENT_CHUNKS]
-
-    context = "\n\n".join(
-        f"Subquery: {r['subquery']}\n- Source: {r['source']}\n- Text: {r['text']}"
-        for r in all_results
-    )
-
-    # print(f"Using {len(all_results)} context chunks for final answer.")
-    # print(f"Using {len(cards_info)} card context for final answer.")
-
-    # adding the MTG golden rules to the context
-    if os.path.exists(RULES_FILE):
-        with open(RULES_FILE, "r", encoding="utf-8", errors="ignore") as f:
-            rules_text = f.read()
-
-        start_marker = "101. The Magic Golden Rules"
-        end_marker = "102. Players"
-        # Skip the first occurrence (the index)
-        first = rules_text.find(start_marker)
-        start_idx = rules_text.find(start_marker, first + 1) if first != -1 else -1
-        if start_idx != -1:
-            end_idx = rules_text.find(end_marker, start_idx)
-            if end_idx != -1:
-                golden_rules = rules_text[start_idx:end_idx].strip()
-                context = f"{golden_rules}\n\n{context}"
+# -------- HELPER RETRIEVE CARD RULINGS --------
+def retrieve_card_rulings(user_prompt, subqueries, cards_info):
+    """
+    Keep only the CARD_RULINGS_PER_CARD rulings of each card that are closest to the question and its subqueries.
 
-    # Wrap context clearly
-    wrapped_context = f"""
-    <<<RULES_AND_CARD_CONTEXT>>>
-    {context}
+    Cards with few rulings, or not in the card rulings index yet (scripts/build_card_index.py), keep all of them.
+    Indexed rulings are matched to the card by their content hash, so rulings changed since the index was built are skipped.
+    The pipelines embed the question along with the subqueries before the rules search, so the vectors come from the cache.
 
-    Cards:
-    {json.dumps(cards_info) if cards_info else "No specific cards provided."}
-    <<<END_CONTEXT>>>
+    Returns:
+        list[dict]: Copies of the cards with their rulings narrowed down, in their original order.
     """
-
-    # Response format instructions
-    response_format = """
+    if not needs_ruling_narrowing(cards_info):
+        return cards_info
+
+    collection = get_card_rulings_collection()
+    if collection.count() == 0:
+        return cards_info
+
+    queries = [q for q in subqueries + [user_prompt] if q.strip() and not only_rule_references(q)]
+    if not queries:
+        return cards_info
+    vecs = embed_texts(queries)
+
+    narrowed = []
+    for card in cards_info:
+        rulings = card.get("rulings") or []
+        if len(rulings) <= CARD_RULINGS_PER_CARD:
+            narrowed.append(card)
+            continue
+
+        with span("mtg_call_seconds", call="chroma_query", stage="card_rulings"):
+            res = collection.query(
+                query_embeddings=vecs,
+                n_results=CARD_RULINGS_PER_CARD,
+                where={"$and": [{"uuid": card["uuid"]}, {"kind": "ruling"}]},
+                include=["metadatas", "distances"]
+            )
+
+        # current position of each ruling by content hash: an index older than the cards file may have other rulings
+        positions = {}
+        for i, ruling in enumerate(rulings):
+            positions.setdefault(content_hash(ruling_text(ruling)), i)
+
+        # best distance of each ruling over all queries
+        best = {}
+        for metas, dists in zip(res["metadatas"], res["distances"]):
+            for meta, dist in zip(metas, dists):
+                i = positions.get((meta or {}).get("content_hash"))
+                if i is not None: # stale ruling, rerun scripts/build_card_index.py
+                    best[i] = min(dist, best.get(i, dist))
+
+        if not best:
+            narrowed.append(card)
+            continue
+
+        keep = sorted(sorted(best, key=best.get)[:CARD_RULINGS_PER_CARD])
+        narrowed.append({**card, "rulings": [rulings[i] for i in keep]})
+
+    return narrowed
+
+# -------- PROMPTS --------
+# Static instructions go first (system message) and the per-question context after them, so the
+# prompt prefix is identical across questions and calls and provider-side prompt caching can hit.
+
+# Response format instructions
+RESPONSE_FORMAT = """
     Provide a structured JSON with the following fields:
 
     - "question": rephrased user question (clarify but keep same logic).
@@ -201,8 +429,8 @@ def answer_with_subqueries(user_prompt, cards_info):
     - "single_word_answer": One of "yes", "no", "unclear", "denied".
     """
 
-    # System prompt with harder constraints
-    system_prompt = f"""
+# System prompt with harder constraints
+JUDGE_SYSTEM_PROMPT = f"""
     You are an expert Magic: The Gathering judge assistant.
 
     RULES:
@@ -218,27 +446,10 @@ def answer_with_subqueries(user_prompt, cards_info):
     - Always give priority to the golden rules of magic, added in the context.
 
     Answer format:
-    {response_format}
-
-    Context:
-    {wrapped_context}
+    {RESPONSE_FORMAT}
     """
 
-    # Initial judge call
-    resp = client.chat.completions.create(
-        model=CHAT_MODEL,
-        temperature=MODEL_LOW_TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        response_format={"type": "json_object"} 
-    )
-
-    judge1_answer = resp.choices[0].message.content
-
-    # ---------- SECONDARY JUDGE ----------
-    judge2_system_prompt = f"""
+JUDGE2_SYSTEM_PROMPT = """
     You are an expert MTG high judge reviewing another judge’s ruling.
 
     You will be given:
@@ -250,60 +461,47 @@ def answer_with_subqueries(user_prompt, cards_info):
     If you disagree: reply with "Denied, [reason + extra context suggestions]".
     """
 
+# -------- HELPER JUDGE PROMPTS --------
+def judge_messages_for(user_prompt, assembled):
+    """Messages of the first judge call: instructions, then the assembled context and the question."""
+    # Wrap context clearly
+    wrapped_context = f"""
+    <<<RULES_AND_CARD_CONTEXT>>>
+    {assembled["context"]}
+
+    Cards:
+    {assembled["cards"]}
+    <<<END_CONTEXT>>>
+    """
+
+    return [
+        {"role": "system", "content": JUDGE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{wrapped_context}\n\nQuestion:\n{user_prompt}"}
+    ]
+
+def judge2_messages_for(user_prompt, assembled, judge1_answer):
+    """Messages of the second judge call, reviewing the first ruling with the same context."""
     judge_prompt = f"""
     User Question:
     {user_prompt}
 
     Context Used:
-    {context}
+    {assembled["context"]}
 
     Cards available (card texts):
-    {json.dumps(cards_info) if len(cards_info) != 0 else "No specific cards provided."}
+    {assembled["cards"]}
 
     Judge's Ruling:
     {judge1_answer}
     """
 
-    #* Secondary judge calling
-    resp2 = client.chat.completions.create(
-        model=CHAT_MODEL,
-        temperature=MODEL_HIGH_TEMPERATURE,
-        messages=[
-            {"role": "system", "content": judge2_system_prompt},
-            {"role": "user", "content": judge_prompt}
-        ]
-    )
-
-    judge2_response = resp2.choices[0].message.content.strip()
-
-    # ---------- ACCEPTED CASE ----------
-    if judge2_response.startswith("Accepted"):
-        return safe_json_parse(judge1_answer)
-
-    # ---------- DENIED CASE ----------
-    # Generate refined subqueries based on judge2 feedback
-    new_subqueries = generate_subqueries(judge2_response)
-    print("2nd judge conflict")
-
-    refined_results = []
-    for sq in new_subqueries:
-        results = search_index(sq)
-        for r in results:
-            refined_results.append({
-                "subquery": sq,
-                "source": r["metadata"].get("source", ""),
-                "text": r["text"]
-            })
-
-    # Keep within limits
-    if len(refined_results) > MAX_CONTENT_CHUNKS:
-        refined_results = refined_results[:MAX_CONTENT_CHUNKS]
-
-    refined_context = "\n\n".join(
-        f"Subquery: {r['subquery']}\n- Source: {r['source']}\n- Text: {r['text']}"
-        for r in refined_results
-    )
+    return [
+        {"role": "system", "content": JUDGE2_SYSTEM_PROMPT},
+        {"role": "user", "content": judge_prompt}
+    ]
 
+def refinement_messages_for(judge_messages, judge1_answer, judge2_response, refined_context):
+    """Messages of the refinement call: the first judge conversation plus the feedback and the new context."""
     new_prompt = f"""
     A higher judge denied your ruling for lack of context. Use the new context and improve your ruling.
 
@@ -316,17 +514,127 @@ def answer_with_subqueries(user_prompt, cards_info):
     Use the same JSON format and card information as before.
     """
 
+    # same prefix as the first call, so it is served from the prompt cache
+    return judge_messages + [
+        {"role": "assistant", "content": judge1_answer},
+        {"role": "user", "content": new_prompt}
+    ]
+
+# -------- HELPER CHAT TEXT --------
+def chat_text(stage, stream_tokens=False, **kwargs):
+    """
+    Run a chat completion and return its text. Meant to be used with `yield from` inside iter_answer_stages.
+    If stream_tokens is True, the completion is streamed and every delta is yielded as a ("token", {...}) event.
+    """
+    if not stream_tokens:
+        return chat(stage, **kwargs)
+
+    parts = []
+    for delta in chat_stream(stage, **kwargs):
+        parts.append(delta)
+        yield "token", {"stage": stage, "text": delta}
+
+    return "".join(parts)
+
+# ---------- ANSWER WITH SUBQUERIES ----------
+def answer_with_subqueries(user_prompt, cards_info, mode="thorough"):
+    """Break question into subqueries, search index for each, and generate final structured ruling."""
+    for event, data in iter_answer_stages(user_prompt, cards_info, mode=mode):
+        if event == "result":
+            return data
+
+# ---------- ITER ANSWER STAGES ----------
+def iter_answer_stages(user_prompt, cards_info, stream_tokens=False, mode="thorough"):
+    """
+    Run the answer pipeline step by step, yielding (event, data) tuples as each stage finishes:
+    "subqueries", "context", "judge1", "judge2", "refinement" (only on a denial) and finally "result" with the ruling.
+    If stream_tokens is True, the judge 1 draft and the refined ruling are also yielded token by token as "token" events.
+    The mode (see ASK_MODES) sets the retrieval sizes and whether the subqueries are re-selected and the second judge runs.
+    Every stage is timed into the mtg_stage_seconds metric (and the request timings, if recorded).
+    """
+    settings = ASK_MODES[mode]
+
+    # Step 1: Generate subqueries
+    with span("mtg_stage_seconds", stage="subqueries"):
+        subqueries = generate_subqueries(user_prompt, settings["max_subqueries"], settings["select_subqueries"])
+    yield "subqueries", {"subqueries": subqueries}
+
+    # Step 2: Collect retrieval results
+    with span("mtg_stage_seconds", stage="retrieval"):
+        if needs_ruling_narrowing(cards_info):
+            # one embeddings request with the question, the card rulings below reuse the cached vectors
+            embed_texts([q.strip() for q in subqueries + [user_prompt] if q.strip() and not (HYBRID_SEARCH and only_rule_references(q))])
+        all_results = collect_results(subqueries, settings["top_k"])
+
+    with span("mtg_stage_seconds", stage="context"):
+        # Dedupe, rerank and diversify into at most max_content_chunks distinct chunks
+        all_results = select_context(all_results, settings["max_content_chunks"])
+
+        # Only the rulings of the selected cards that matter for this question
+        cards_info = retrieve_card_rulings(user_prompt, subqueries, cards_info)
+
+        # Fit golden rules, compact card data, the best chunks and then the rules they cite into the judge token budget
+        rules_index = get_rules_index()
+        assembled = assemble_context(all_results + reference_chunks(all_results, rules_index), cards_info, settings["context_token_budget"], rules_index.golden_rules)
+        all_results = assembled["chunks"]
+    yield "context", {"chunks": len(all_results), "cards": len(cards_info), "tokens": assembled["tokens"]}
+
+    judge_messages = judge_messages_for(user_prompt, assembled)
+
+    # Initial judge call
+    with span("mtg_stage_seconds", stage="judge1"):
+        judge1_answer = yield from chat_text(
+            "judge1",
+            stream_tokens,
+            model=CHAT_MODEL,
+            temperature=MODEL_LOW_TEMPERATURE,
+            messages=judge_messages,
+            response_format={"type": "json_object"} 
+        )
+    yield "judge1", {"ruling": safe_json_parse(judge1_answer)}
+
+    # Fast mode: judge 1 ruling without review
+    if not settings["second_judge"]:
+        yield "result", safe_json_parse(judge1_answer)
+        return
+
+    # ---------- SECONDARY JUDGE ----------
+    with span("mtg_stage_seconds", stage="judge2"):
+        judge2_response = chat(
+            "judge2",
+            model=CHAT_MODEL,
+            temperature=MODEL_HIGH_TEMPERATURE,
+            messages=judge2_messages_for(user_prompt, assembled, judge1_answer)
+        ).strip()
+    metrics.inc("mtg_judge_verdicts_total", verdict="accepted" if judge2_response.startswith("Accepted") else "denied")
+    yield "judge2", {"verdict": "Accepted" if judge2_response.startswith("Accepted") else "Denied", "feedback": judge2_response}
+
+    # ---------- ACCEPTED CASE ----------
+    if judge2_response.startswith("Accepted"):
+        yield "result", safe_json_parse(judge1_answer)
+        return
+
+    # ---------- DENIED CASE ----------
+    # Generate refined subqueries based on judge2 feedback
+    print("2nd judge conflict")
+    with span("mtg_stage_seconds", stage="refinement_context"):
+        new_subqueries = generate_subqueries(judge2_response, settings["max_subqueries"], settings["select_subqueries"])
+        refined_results = collect_results(new_subqueries, settings["top_k"])
+
+        # Keep within limits, without the chunks the judge already has. The cards are already in the conversation.
+        refined_results = select_context(refined_results, settings["max_content_chunks"], exclude_ids=[r["id"] for r in all_results])
+        refined = assemble_context(refined_results, [], REFINEMENT_CONTEXT_TOKEN_BUDGET)
+    yield "refinement", {"subqueries": new_subqueries, "chunks": len(refined["chunks"]), "tokens": refined["tokens"]}
+
     #* Loop back to initial judge
-    resp3 = client.chat.completions.create(
-        model=CHAT_MODEL,
-        temperature=MODEL_LOW_TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-            {"role": "assistant", "content": judge1_answer},
-            {"role": "user", "content": new_prompt}
-        ],
-        response_format={"type": "json_object"} 
-    )
+    with span("mtg_stage_seconds", stage="refinement"):
+        refined_answer = yield from chat_text(
+            "refinement",
+            stream_tokens,
+            model=CHAT_MODEL,
+            temperature=MODEL_LOW_TEMPERATURE,
+            messages=refinement_messages_for(judge_messages, judge1_answer, judge2_response, refined["context"]),
+            response_format={"type": "json_object"} 
+        )
 
-    return safe_json_parse(resp3.choices[0].message.content)
+    yield "result", safe_json_parse(refined_answer)
@@ -0,0 +1,109 @@
+# -------- IMPORTS --------
+import re
+
+# -------- CONFIG --------
+from utils.index_utils import load_rules
+
+# "702.19b", "702.19", "702" or "7"
+RULE_ID_PATTERN = re.compile(r"\b\d{1,3}(?:\.\d+[a-z]?)?\b")
+# "See rule 702.19b", "see rules 510.1c-d and 702.19", "See also rule 613."
+REFERENCE_PATTERN = re.compile(r"[Ss]ee (?:also )?rules? ((?:\d{3}(?:\.\d+[a-z]?)?(?:-[a-z])?(?:,? (?:and |or )?)?)+)")
+# one cited id in a reference, with an optional subrule range: "702.19", "702.19b", "510.1c-d"
+REFERENCE_ID_PATTERN = re.compile(r"\b(\d{3}(?:\.\d+)?)([a-z])?(?:-([a-z]))?\b")
+GOLDEN_RULES_SECTION = "101"
+
+# -------- RULES INDEX --------
+class RulesIndex:
+    """
+    Structured, in-memory view of the comprehensive rules built from the load_rules parse.
+
+    Keeps rule_id -> text and rule_id -> children maps (section "702" -> rule "702.19" -> subrule "702.19b"),
+    so golden rules, cited rules and "see rule X" cross-references are resolved without touching disk.
+    """
+
+    def __init__(self, rules):
+        self.texts = {}    # rule_id -> rule text (starting with its id)
+        self.children = {} # rule_id -> direct child rule ids, in rules order
+
+        for r in rules:
+            rule_id = r["rule_id"]
+            self.texts[rule_id] = r["text"]
+            self.children.setdefault(rule_id, [])
+            parent = self.parent_id(rule_id)
+            if parent is not None:
+                self.children.setdefault(parent, []).append(rule_id)
+
+        self.golden_rules = self.section_text(GOLDEN_RULES_SECTION)
+
+    @classmethod
+    def from_file(cls, path):
+        """Parse a comprehensive rules text file into a RulesIndex."""
+        return cls(load_rules(path))
+
+    @staticmethod
+    def parent_id(rule_id):
+        """Parent of a rule id: "702.19b" -> "702.19" -> "702" -> "7" -> None."""
+        if rule_id[-1].isalpha():
+            return rule_id[:-1]
+        if "." in rule_id:
+            return rule_id.rsplit(".", 1)[0]
+        if len(rule_id) == 3:
+            return rule_id[0]
+        return None
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get(self, rule_id):
+        """Return the text of a single rule (e.g. "702.19b"), or None if it doesn't exist."""
+        return self.texts.get(rule_id.strip().rstrip("."))
+
+    def section(self, rule_id):
+        """Return the rule ids of a rule and all its descendants, in rules order."""
+        rule_id = rule_id.strip().rstrip(".")
+        if rule_id not in self.texts:
+            return []
+
+        ids = [rule_id]
+        for child in self.children.get(rule_id, []):
+            ids.extend(self.section(child))
+        return ids
+
+    def section_text(self, rule_id):
+        """Return the text of a rule and all its descendants (e.g. "101" for the golden rules)."""
+        return "\n\n".join(self.texts[i] for i in self.section(rule_id))
+
+    def references(self, text):
+        """Return the rule ids cited as "see rule X" in a text ("see rules 510.1c-d" is 510.1c and 510.1d), in order and without duplicates."""
+        ids = []
+        for match in REFERENCE_PATTERN.finditer(text):
+            for base, first, last in REFERENCE_ID_PATTERN.findall(match.group(1)):
+                letters = [chr(c) for c in range(ord(first), ord(last) + 1)] if first and last else [first]
+                for letter in letters:
+                    if base + letter not in ids:
+                        ids.append(base + letter)
+        return ids
+
+    def expand_references(self, text, depth=1):
+        """
+        Resolve the "see rule X" cross-references of a text (a rule or a retrieved chunk).
+
+        Args:
+            text (str): The text whose references are expanded.
+            depth (int): How many levels of references to follow.
+
+        Returns:
+            dict[str, str]: Referenced rule id -> text, for every reference that exists in the rules.
+        """
+        expanded = {}
+        pending = [text]
+        for _ in range(depth):
+            found = []
+            for current in pending:
+                for ref in self.references(current):
+                    rule_text = self.get(ref)
+                    if rule_text is not None and ref not in expanded:
+                        expanded[ref] = rule_text
+                        found.append(rule_text)
+            pending = found
+        return expanded
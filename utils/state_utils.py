@@ -0,0 +1,120 @@
+# -------- IMPORTS --------
+import os
+import gc
+import time
+
+try:
+    import resource # not on Windows, only used when /proc isn't there
+except ImportError:
+    resource = None
+
+# -------- CONFIG --------
+from utils.config_utils import HYBRID_SEARCH, RETRIEVAL_BACKEND
+from utils.card_utils import get_card_store
+from utils.model_utils import get_rules_index, get_lexical_index, get_vector_store, get_rules_collection, get_card_rulings_collection
+
+# Startup of this process (reset in each forked worker): seconds to load each component, and to get ready
+startup = {"preloaded": False, "components": {}, "ready_seconds": None}
+_started = time.monotonic()
+
+# -------- HELPER MEMORY USAGE --------
+def memory_usage():
+    """
+    Memory of this process in bytes: "rss" (resident) and, on Linux, "pss" (resident with the pages shared
+    with other processes, like the preloaded data of forked workers, split between them). pss is None elsewhere.
+    """
+    rss, pss = None, None
+    try:
+        with open("/proc/self/status", "r") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        with open("/proc/self/smaps_rollup", "r") as f:
+            pss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("Pss:"))
+    except (OSError, StopIteration, ValueError):
+        pass
+
+    if rss is None and resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # peak, not current (KB on Linux)
+    return {"rss": rss, "pss": pss}
+
+# -------- HELPER LOAD COMPONENT --------
+def load_component(name, loader):
+    """Run loader() and record how long it took in startup["components"]."""
+    started = time.perf_counter()
+    loader()
+    startup["components"][name] = round(time.perf_counter() - started, 3)
+
+# -------- PRELOAD --------
+def preload(freeze=True):
+    """
+    Load the read-only data every request needs: rules, card store (catalog and name matcher), BM25 index and,
+    with the numpy backend, the memory-mapped vectors.
+
+    Call it in the master process before forking the workers (gunicorn.conf.py does) so they share it copy-on-write
+    (the vectors through the page cache) instead of each loading its own copy. Chroma, SQLite and the OpenAI clients
+    are not fork-safe and are opened lazily by each worker. Without preload() everything loads on first use.
+
+    The rules, cards and postings are Python dicts and lists: the garbage collector writes to the header of every
+    one of them when it runs, which copies their pages into each worker. With freeze (the default) they are moved
+    to the permanent generation with gc.freeze() so the collector of the workers leaves them alone.
+    """
+    load_component("rules_index", get_rules_index)
+    load_component("card_store", lambda: (get_card_store().reload_if_changed(), get_card_store().catalog(), get_card_store().name_matcher())) # opens it
+    if HYBRID_SEARCH:
+        load_component("lexical_index", get_lexical_index)
+    if RETRIEVAL_BACKEND == "numpy":
+        load_component("vector_store", get_vector_store)
+
+    if freeze:
+        gc.collect() # free the loading garbage first, so it isn't frozen with the data
+        gc.freeze()
+
+    startup["preloaded"] = True
+    print(f"Preloaded {', '.join(f'{k} ({v}s)' for k, v in startup['components'].items())} in process {os.getpid()}, RSS {(memory_usage()['rss'] or 0) / 2**20:.0f} MB")
+
+# -------- AFTER FORK --------
+def after_fork():
+    """Reset the startup measures in a freshly forked worker. The preloaded components stay loaded (shared)."""
+    global _started
+    _started = time.monotonic()
+    startup.update(ready_seconds=None, components={name: 0.0 for name in startup["components"]})
+
+# -------- READINESS --------
+def readiness():
+    """
+    Load whatever is still missing (the per-worker Chroma collections at least) and check every component is usable.
+
+    Returns:
+        tuple[bool, dict]: (ready, {component: "ok", "empty" or the error}).
+    """
+    checks = {
+        "rules_index": lambda: len(get_rules_index()) > 0,
+        "card_store": lambda: len(get_card_store()) > 0,
+        "rules_collection": lambda: get_rules_collection().count() > 0 if RETRIEVAL_BACKEND == "chroma" else len(get_vector_store()) > 0,
+        "card_rulings_collection": lambda: get_card_rulings_collection() is not None, # optional, may be empty
+    }
+    if HYBRID_SEARCH:
+        checks["lexical_index"] = lambda: len(get_lexical_index()) > 0
+
+    results = {}
+    for name, check in checks.items():
+        started = time.perf_counter()
+        try:
+            results[name] = "ok" if check() else "empty"
+        except Exception as e:
+            results[name] = f"{type(e).__name__}: {e}"
+        startup["components"].setdefault(name, round(time.perf_counter() - started, 3))
+
+    ready = all(status == "ok" for status in results.values())
+    if ready and startup["ready_seconds"] is None:
+        startup["ready_seconds"] = round(time.monotonic() - _started, 3)
+    return ready, results
+
+# -------- PROCESS STATUS --------
+def process_status():
+    """Pid, uptime, memory and startup measures of this process (worker)."""
+    return {
+        "pid": os.getpid(),
+        "uptime_seconds": round(time.monotonic() - _started, 1),
+        "memory": memory_usage(),
+        "startup": startup
+    }
@@ -0,0 +1,146 @@
+# -------- IMPORTS --------
+import time
+import random
+import threading
+import openai
+
+# -------- CONFIG --------
+from utils.config_utils import (
+    CHAT_REQUESTS_PER_MINUTE, CHAT_TOKENS_PER_MINUTE, EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE, RATE_LIMIT_BURST_SECONDS,
+    STAGE_DEADLINES_SECONDS, DEFAULT_STAGE_DEADLINE_SECONDS, OPENAI_MAX_RETRIES, OPENAI_RETRY_BASE_SECONDS, OPENAI_RETRY_MAX_SECONDS
+)
+from utils.metrics_utils import metrics
+
+# errors worth sending the same request again for
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+class DeadlineExceededError(TimeoutError):
+    """An OpenAI call could not be sent or finished within the deadline of its stage."""
+
+# -------- TOKEN BUCKET --------
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at per_minute / 60 per second, holding at most burst_seconds of refill.
+
+    Callers reserve what they need and wait the returned time: the bucket can go negative, so concurrent
+    callers queue up behind each other instead of all retrying at once. per_minute 0 disables the limit.
+    """
+
+    def __init__(self, per_minute, burst_seconds=RATE_LIMIT_BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount from the bucket. Returns the seconds to wait before using it."""
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+    def refund(self, amount):
+        """Give back a reservation that won't be used."""
+        if not self.rate:
+            return
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+# Create the rate limiters once (outside function, at server startup), shared by every thread: kind -> (requests, tokens)
+rate_limiters = {
+    "chat": (TokenBucket(CHAT_REQUESTS_PER_MINUTE), TokenBucket(CHAT_TOKENS_PER_MINUTE)),
+    "embeddings": (TokenBucket(EMBED_REQUESTS_PER_MINUTE), TokenBucket(EMBED_TOKENS_PER_MINUTE)),
+}
+
+# -------- HELPER RETRY AFTER --------
+def retry_after_seconds(error):
+    """The retry-after header of an API error response in seconds, or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# -------- HELPER ESTIMATE TOKENS --------
+def estimate_tokens(texts):
+    """Rough token count of texts for the rate limiters (4 characters per token, no tokenizer on the hot path)."""
+    return sum(len(t) for t in texts) // 4 + 1
+
+# -------- CALL POLICY --------
+class CallPolicy:
+    """
+    Rate limits, deadline and retries of one OpenAI call, over all its attempts.
+    The sync and async call helpers of llm_utils share it, only the way they wait differs:
+
+        policy = CallPolicy("chat", "judge1", tokens)
+        while True:
+            sleep(policy.acquire())
+            try:
+                return send(timeout=policy.timeout())
+            except Exception as e:
+                sleep(policy.retry_delay(e)) # raises when the error can't or shouldn't be retried
+    """
+
+    def __init__(self, kind, stage, tokens):
+        self.kind = kind
+        self.stage = stage
+        self.tokens = tokens
+        self.deadline = time.monotonic() + STAGE_DEADLINES_SECONDS.get(stage, DEFAULT_STAGE_DEADLINE_SECONDS)
+        self.attempt = 0
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def _expired(self, reason):
+        metrics.inc("mtg_openai_deadline_exceeded_total", kind=self.kind, stage=self.stage)
+        return DeadlineExceededError(f"OpenAI {self.kind} call of stage {self.stage} {reason}.")
+
+    def acquire(self):
+        """Reserve one request and the estimated tokens of an attempt. Returns the seconds to wait before sending it."""
+        requests, tokens = rate_limiters[self.kind]
+        wait = max(requests.reserve(1), tokens.reserve(self.tokens))
+        if wait <= 0:
+            return 0
+
+        if wait >= self.remaining():
+            requests.refund(1)
+            tokens.refund(self.tokens)
+            raise self._expired(f"would wait {wait:.1f}s for the rate limit, past its deadline")
+
+        metrics.inc("mtg_openai_throttled_total", kind=self.kind)
+        metrics.observe("mtg_openai_throttle_seconds", wait, kind=self.kind)
+        return wait
+
+    def timeout(self):
+        """Timeout of the next attempt: what is left of the deadline."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise self._expired("ran out of time")
+        return remaining
+
+    def retry_delay(self, error):
+        """
+        Seconds to wait before retrying after error: the server's retry-after, or full jitter exponential backoff.
+        Raises error itself if it isn't retryable or the retries are used up, DeadlineExceededError if there is no time left.
+        """
+        if not isinstance(error, RETRYABLE_ERRORS) or self.attempt >= OPENAI_MAX_RETRIES:
+            raise error
+
+        self.attempt += 1
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = random.uniform(0, min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** self.attempt))
+
+        if delay >= self.remaining():
+            raise self._expired(f"failed ({type(error).__name__}) with no time left to retry") from error
+
+        metrics.inc("mtg_openai_retries_total", kind=self.kind, error=type(error).__name__)
+        print(f"[{self.stage}] OpenAI {self.kind} call failed ({type(error).__name__}), retry {self.attempt} in {delay:.1f}s")
+        return delay
@@ -0,0 +1,155 @@
+# -------- IMPORTS --------
+import os
+import json
+import numpy as np
+
+# -------- CONFIG --------
+from utils.config_utils import VECTOR_EXPORT_DIR, INDEX_BATCH_SIZE
+
+CURRENT_EXPORT_FILE = os.path.join(VECTOR_EXPORT_DIR, "current") # holds the name of the export the server loads
+EXPORT_DTYPES = ("float32", "float16", "int8")
+SCORE_BLOCK_ROWS = 4096 # rows of a quantized matrix widened to float32 at a time while scoring
+
+# -------- HELPER EXPORT VECTORS --------
+def export_vectors(collection, dtype="float32", publish=True):
+    """
+    Export a Chroma collection to a memory-mappable matrix for NumpyVectorStore.
+
+    Vectors are L2-normalized (cosine similarity becomes a dot product) and stored as float32, float16,
+    or int8 with one float32 scale per row. ids, documents and metadatas go to a sidecar meta.json.
+    The export is written to its own folder and published by atomically updating VECTOR_EXPORT_DIR/current.
+
+    Args:
+        collection: The Chroma collection to export.
+        dtype (str): One of EXPORT_DTYPES.
+        publish (bool): Make it the export loaded by the server (False for benchmarks).
+
+    Returns:
+        str: The folder of the export.
+    """
+    if dtype not in EXPORT_DTYPES:
+        raise ValueError(f"dtype must be one of {EXPORT_DTYPES}")
+
+    ids, documents, metadatas, vectors = [], [], [], []
+    total = collection.count()
+    for offset in range(0, total, INDEX_BATCH_SIZE * 10):
+        batch = collection.get(include=["embeddings", "documents", "metadatas"], limit=INDEX_BATCH_SIZE * 10, offset=offset)
+        ids.extend(batch["ids"])
+        documents.extend(batch["documents"])
+        metadatas.extend(batch["metadatas"])
+        vectors.extend(batch["embeddings"])
+
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.maximum(norms, 1e-12)
+
+    name = f"{collection.name}_{dtype}"
+    out_dir = os.path.join(VECTOR_EXPORT_DIR, name)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # every file is written aside and moved in place, a running server may still have the old ones mapped
+    def save(filename, write):
+        tmp_path = os.path.join(out_dir, f"{filename}.tmp")
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, os.path.join(out_dir, filename))
+
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        save("vectors.npy", lambda f: np.save(f, np.round(matrix / scales[:, None]).astype(np.int8)))
+        save("scales.npy", lambda f: np.save(f, scales.astype(np.float32)))
+    else:
+        save("vectors.npy", lambda f: np.save(f, matrix.astype(dtype)))
+
+    meta = {"collection": collection.name, "dtype": dtype, "ids": ids, "documents": documents, "metadatas": metadatas}
+    save("meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    if publish:
+        tmp_path = f"{CURRENT_EXPORT_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(tmp_path, CURRENT_EXPORT_FILE)
+
+    print(f"Exported {len(ids)} vectors ({dtype}) to {out_dir}")
+    return out_dir
+
+# -------- HELPER CURRENT EXPORT --------
+def get_current_export_dir():
+    """Folder of the export the server should load, or None if nothing was exported yet."""
+    try:
+        with open(CURRENT_EXPORT_FILE, "r", encoding="utf-8") as f:
+            return os.path.join(VECTOR_EXPORT_DIR, f.read().strip())
+    except OSError:
+        return None
+
+# -------- NUMPY VECTOR STORE --------
+class NumpyVectorStore:
+    """
+    Exact top-k search over an exported, memory-mapped vector matrix.
+
+    A batch of queries is answered with one matrix multiplication and an argpartition,
+    and the result has the same shape as a Chroma query result.
+    """
+
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        with open(os.path.join(export_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        self.collection = meta["collection"]
+        self.dtype = meta["dtype"]
+        self.ids = meta["ids"]
+        self.documents = meta["documents"]
+        self.metadatas = meta["metadatas"]
+
+        # mmap: the OS shares the pages between processes and only loads what is touched
+        self.vectors = np.load(os.path.join(export_dir, "vectors.npy"), mmap_mode="r")
+        scales_path = os.path.join(export_dir, "scales.npy")
+        self.scales = np.load(scales_path) if self.dtype == "int8" else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, query_embeddings, n_results):
+        """
+        Return the n_results closest vectors of each query by cosine similarity.
+
+        Args:
+            query_embeddings (list[list[float]]): The query vectors.
+            n_results (int): Results per query.
+
+        Returns:
+            dict: Chroma-like {"ids", "documents", "metadatas", "distances"}, one list per query. Distances are cosine distances.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        if self.dtype == "float32":
+            scores = queries @ self.vectors.T
+        else:
+            # quantized rows are widened to float32 block by block to keep memory bounded
+            scores = np.empty((len(queries), len(self.ids)), dtype=np.float32)
+            for start in range(0, len(self.ids), SCORE_BLOCK_ROWS):
+                block = np.asarray(self.vectors[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+                scores[:, start:start + len(block)] = queries @ block.T
+            if self.scales is not None:
+                scores *= self.scales
+
+        k = min(n_results, len(self.ids))
+        if k == 0:
+            return {"ids": [[] for _ in queries], "documents": [[] for _ in queries], "metadatas": [[] for _ in queries], "distances": [[] for _ in queries]}
+
+        # argpartition picks the top k unordered in O(n), then only those k are sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return {
+            "ids": [[self.ids[i] for i in row] for row in top],
+            "documents": [[self.documents[i] for i in row] for row in top],
+            "metadatas": [[self.metadatas[i] for i in row] for row in top],
+            "distances": (1.0 - top_scores).tolist()
+        }